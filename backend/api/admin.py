@@ -0,0 +1,30 @@
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+
+from .profiling import list_profiles, read_profile
+
+
+@staff_member_required
+def profiles(request):
+    """Список профилей обработчиков, собранных ProfilingMiddleware."""
+    return render(request, 'admin/profiles.html', {
+        **admin.site.each_context(request),
+        'title': 'Профили запросов',
+        'profiles': list_profiles(),
+    })
+
+
+@staff_member_required
+def profile_download(request, name):
+    """
+    Отдаёт профиль обработчика в формате folded stacks
+    для flamegraph.pl или speedscope.
+    """
+    content = read_profile(name)
+    if content is None:
+        raise Http404
+    response = HttpResponse(content, content_type='text/plain')
+    response['Content-Disposition'] = f'attachment; filename="{name}"'
+    return response
@@ -5,3 +5,6 @@ class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
     verbose_name = 'Foodgram API'
+
+    def ready(self):
+        from . import bitmaps, checks, registries  # noqa: F401
@@ -0,0 +1,467 @@
+import threading
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from functools import partial
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .registries import is_shared_cache
+from recipes.models import Cart, Favorite, Recipe
+from recipes.services import collection_changed
+
+RecipeTags = Recipe.tags.through
+COLLECTIONS = {
+    'favorite': Favorite,
+    'cart': Cart,
+}
+THROUGH_COLLECTIONS = {
+    model.recipes.through: name for name, model in COLLECTIONS.items()
+}
+# Размер куска битовой карты, который пропускается при выборе
+# страницы одним bit_count.
+CHUNK_BYTES = 256
+EMPTY = array('i')
+
+
+def to_bitmap(positions):
+    """Битовая карта из номеров позиций."""
+    positions = list(positions)
+    if not positions:
+        return 0
+    bits = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def to_bytes(bitmap):
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+
+def has_position(bits, position):
+    """Установлен ли бит position в битовой карте из to_bytes."""
+    index = position >> 3
+    return index < len(bits) and bits[index] >> (position & 7) & 1
+
+
+def iter_positions(bitmap, start=0):
+    """
+    Номера установленных битов от старшего к младшему,
+    начиная с `start`-го по счёту. Куски до страницы пропускаются
+    по bit_count, в Python перебираются только биты кусков страницы.
+    """
+    bits = to_bytes(bitmap)
+    for end in range(len(bits), 0, -CHUNK_BYTES):
+        begin = max(end - CHUNK_BYTES, 0)
+        chunk = int.from_bytes(bits[begin:end], 'little')
+        count = chunk.bit_count()
+        if start >= count:
+            start -= count
+            continue
+        digits = bin(chunk)[2:]
+        top = begin * 8 + len(digits) - 1
+        positions = [
+            top - index for index, digit in enumerate(digits) if digit == '1'
+        ]
+        yield from positions[start:]
+        start = 0
+
+
+def add_position(positions, position):
+    index = bisect_left(positions, position)
+    if index == len(positions) or positions[index] != position:
+        positions.insert(index, position)
+
+
+def remove_position(positions, position):
+    index = bisect_left(positions, position)
+    if index < len(positions) and positions[index] == position:
+        del positions[index]
+
+
+class RecipeBitmapIndex:
+    """
+    Индекс рецептов в памяти процесса для RecipieFilter.
+    Каждому рецепту выдаётся позиция в порядке публикации. Для тэгов,
+    которых немного, хранятся битовые карты (int) позиций их рецептов,
+    для авторов, избранного и корзин пользователей - отсортированные
+    массивы позиций: память на них пропорциональна числу связей,
+    а не числу рецептов. Фильтры комбинируются битовыми операциями
+    и пересечением массивов, а из базы читаются только рецепты страницы.
+
+    Изменения после коммита записываются в журнал в кеше Django -
+    кольцо из settings.RECIPE_BITMAP_CHANGES последних изменений
+    под общей версией. Процесс, сделавший запись, применяет изменение
+    сразу, остальные - при следующем обращении по журналу. Индекс
+    перестраивается из базы целиком, только если процесс отстал
+    больше, чем хранит журнал, или изменение нельзя описать
+    (очистка связей, invalidate). Включается settings.RECIPE_BITMAP_INDEX
+    и только при общем для процессов кеше.
+    """
+    version_key = 'recipe-bitmap-version'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._version = 0
+        self.ids = None
+        self.recipe_authors = array('q')
+        self.sorted_ids = array('q')
+        self.sorted_positions = array('i')
+        self.all = 0
+        self.tags = {}
+        self.authors = {}
+        self.collections = {name: {} for name in COLLECTIONS}
+
+        post_save.connect(self.on_recipe_save, sender=Recipe, weak=False)
+        post_delete.connect(self.on_recipe_delete, sender=Recipe, weak=False)
+        m2m_changed.connect(self.on_tags_change, sender=RecipeTags, weak=False)
+        for through in THROUGH_COLLECTIONS:
+            m2m_changed.connect(
+                self.on_collection_change, sender=through, weak=False)
+        collection_changed.connect(self.on_collection_changed, weak=False)
+
+    @staticmethod
+    def is_enabled():
+        # С кешем в памяти процесса изменения из других воркеров
+        # не доходят до индекса, и он отдавал бы устаревшие рецепты.
+        return settings.RECIPE_BITMAP_INDEX and is_shared_cache()
+
+    @staticmethod
+    def change_key(version):
+        slot = version % settings.RECIPE_BITMAP_CHANGES
+        return f'recipe-bitmap-change:{slot}'
+
+    def ensure_fresh(self):
+        version = cache.get(self.version_key, 0)
+        with self._lock:
+            if self.ids is not None and version == self._version:
+                return
+            if self.ids is None or not self.replay(version):
+                self.build()
+                self._version = version
+
+    def replay(self, version):
+        """
+        Применяет к индексу изменения из журнала до версии version.
+        Возвращает False, если нужных изменений в журнале уже нет
+        и индекс надо перестроить.
+        """
+        if not 0 <= version - self._version <= settings.RECIPE_BITMAP_CHANGES:
+            return False
+        versions = range(self._version + 1, version + 1)
+        entries = cache.get_many([self.change_key(item) for item in versions])
+        for item in versions:
+            entry = entries.get(self.change_key(item))
+            if entry is None or entry[0] != item:
+                # Последнее изменение могло ещё не попасть в журнал
+                # после увеличения версии, оно применится при следующем
+                # обращении. Пропуск в середине журнала не восполнить.
+                return item == version
+            if entry[1] is None:
+                return False
+            self.apply(entry[1])
+            self._version = item
+        return True
+
+    def build(self):
+        self.build_recipes()
+        for name in COLLECTIONS:
+            self.build_collection(name)
+
+    def build_recipes(self):
+        # Индекс строится по основной базе: с отстающей реплики он
+        # сохранился бы устаревшим под новой версией.
+        recipes = Recipe.objects.using(DEFAULT_DB_ALIAS).order_by(
+            'publication_date', 'id').values_list('id', 'author_id')
+        ids, recipe_authors = array('q'), array('q')
+        authors = defaultdict(partial(array, 'i'))
+        for position, (pk, author_id) in enumerate(recipes.iterator()):
+            ids.append(pk)
+            recipe_authors.append(author_id or 0)
+            authors[author_id or 0].append(position)
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        self.ids = ids
+        self.recipe_authors = recipe_authors
+        self.sorted_ids = array('q', (ids[position] for position in order))
+        self.sorted_positions = array('i', order)
+        self.all = (1 << len(ids)) - 1
+        self.authors = dict(authors)
+        tags = defaultdict(list)
+        links = RecipeTags.objects.using(DEFAULT_DB_ALIAS).values_list(
+            'recipe_id', 'tag_id')
+        for recipe_id, tag_id in links.iterator():
+            position = self.get_position(recipe_id)
+            if position is not None:
+                tags[tag_id].append(position)
+        self.tags = {
+            tag_id: to_bitmap(positions)
+            for tag_id, positions in tags.items()
+        }
+
+    def build_collection(self, name):
+        links = COLLECTIONS[name].recipes.through.objects.using(
+            DEFAULT_DB_ALIAS).values_list(f'{name}__user_id', 'recipe_id')
+        users = defaultdict(list)
+        for user_id, recipe_id in links.iterator():
+            position = self.get_position(recipe_id)
+            if position is not None:
+                users[user_id].append(position)
+        self.collections[name] = {
+            user_id: array('i', sorted(positions))
+            for user_id, positions in users.items()
+        }
+
+    def invalidate(self):
+        """Перестроить весь индекс во всех процессах."""
+        self.log(None)
+
+    def log(self, change):
+        """
+        Записывает изменение в журнал и применяет его к индексу
+        процесса, если до него индекс был актуален.
+        change=None - индекс перестраивается целиком.
+        """
+        try:
+            version = cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, None)
+            version = 1
+        cache.set(self.change_key(version), (version, change), None)
+        with self._lock:
+            if change is None:
+                self.ids = None
+            elif self.ids is not None and self._version == version - 1:
+                self.apply(change)
+                self._version = version
+
+    def apply(self, change):
+        """Применяет изменение из журнала: (имя метода, *аргументы)."""
+        method, *args = change
+        getattr(self, method)(*args)
+
+    def on_commit(self, change):
+        """Записывает изменение в журнал после коммита."""
+        if not self.is_enabled():
+            self.ids = None
+            return
+        transaction.on_commit(partial(self.log, change))
+
+    def get_position(self, recipe_id):
+        index = bisect_left(self.sorted_ids, recipe_id)
+        if (
+            index < len(self.sorted_ids)
+            and self.sorted_ids[index] == recipe_id
+        ):
+            return self.sorted_positions[index]
+        return None
+
+    def get_bit(self, recipe_id):
+        position = self.get_position(recipe_id)
+        return 0 if position is None else 1 << position
+
+    def add_recipe(self, recipe_id):
+        position = len(self.ids)
+        self.ids.append(recipe_id)
+        self.recipe_authors.append(0)
+        index = bisect_left(self.sorted_ids, recipe_id)
+        self.sorted_ids.insert(index, recipe_id)
+        self.sorted_positions.insert(index, position)
+        return position
+
+    def save_recipe(self, pk, author_id):
+        position = self.get_position(pk)
+        if position is None:
+            position = self.add_recipe(pk)
+        self.all |= 1 << position
+        previous = self.recipe_authors[position]
+        if previous == author_id:
+            return
+        remove_position(self.authors.get(previous, EMPTY), position)
+        add_position(self.authors.setdefault(author_id, array('i')), position)
+        self.recipe_authors[position] = author_id
+
+    def delete_recipe(self, pk):
+        self.all &= ~self.get_bit(pk)
+
+    def change_tags(self, links, added):
+        """links - пары (recipe_id, tag_id)."""
+        for recipe_id, tag_id in links:
+            bit = self.get_bit(recipe_id)
+            bitmap = self.tags.get(tag_id, 0)
+            self.tags[tag_id] = bitmap | bit if added else bitmap & ~bit
+
+    def change_collection(self, name, links, added):
+        """links - пары (user_id, recipe_id)."""
+        users = self.collections[name]
+        for user_id, recipe_id in links:
+            position = self.get_position(recipe_id)
+            if position is None:
+                continue
+            positions = users.setdefault(user_id, array('i'))
+            if added:
+                add_position(positions, position)
+            else:
+                remove_position(positions, position)
+
+    def clear_collection(self, name, user_id):
+        self.collections[name].pop(user_id, None)
+
+    def on_recipe_save(self, instance, created, **kwargs):
+        self.on_commit(
+            ('save_recipe', instance.pk, instance.author_id or 0))
+
+    def on_recipe_delete(self, instance, **kwargs):
+        self.on_commit(('delete_recipe', instance.pk))
+
+    def on_tags_change(self, instance, action, reverse, pk_set, **kwargs):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        if action == 'post_clear':
+            # Какие связи удалены, после очистки уже не узнать.
+            self.on_commit(None)
+            return
+        links = [
+            (pk, instance.pk) if reverse else (instance.pk, pk)
+            for pk in pk_set
+        ]
+        self.on_commit(('change_tags', links, action == 'post_add'))
+
+    def on_collection_change(self, sender, instance, action, reverse,
+                             pk_set, **kwargs):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        if action == 'post_clear':
+            self.on_commit(None)
+            return
+        name = THROUGH_COLLECTIONS[sender]
+        if reverse:
+            links = [
+                (user_id, instance.pk)
+                for user_id in COLLECTIONS[name].objects.filter(
+                    pk__in=pk_set).values_list('user_id', flat=True)
+            ]
+        else:
+            links = [(instance.user_id, pk) for pk in pk_set]
+        self.on_commit(('change_collection', name, links,
+                        action == 'post_add'))
+
+    def on_collection_changed(self, model, user_id, recipe_ids, added,
+                              **kwargs):
+        """
+        Изменение избранного или корзины пользователя;
+        recipe_ids=None - все рецепты убраны.
+        """
+        name = model._meta.model_name
+        if recipe_ids is None:
+            self.on_commit(('clear_collection', name, user_id))
+            return
+        links = [(user_id, recipe_id) for recipe_id in recipe_ids]
+        self.on_commit(('change_collection', name, links, added))
+
+    def filter(self, author_id=None, tag_ids=(), tags_mode='any',
+               collections=()):
+        """
+        Рецепты, подходящие под фильтры.
+        collections - [(имя, user_id, входит ли рецепт)].
+        """
+        self.ensure_fresh()
+        with self._lock:
+            bitmap = self.all
+            if tag_ids:
+                bitmaps = [self.tags.get(tag_id, 0) for tag_id in tag_ids]
+                if tags_mode == 'all':
+                    for tags in bitmaps:
+                        bitmap &= tags
+                else:
+                    tags = 0
+                    for tag_bitmap in bitmaps:
+                        tags |= tag_bitmap
+                    bitmap &= tags
+            included, excluded = [], []
+            if author_id is not None:
+                included.append(self.authors.get(author_id, EMPTY))
+            for name, user_id, is_included in collections:
+                positions = self.collections[name].get(user_id, EMPTY)
+                (included if is_included else excluded).append(positions)
+            if not included:
+                for positions in excluded:
+                    bitmap &= ~to_bitmap(positions)
+                return IndexedRecipes(self, bitmap=bitmap)
+            # Перебираем самый короткий массив и проверяем позиции
+            # по битовой карте и остальным массивам.
+            included.sort(key=len)
+            others = [set(positions) for positions in included[1:]]
+            skipped = set().union(*excluded)
+            bits = to_bytes(bitmap)
+            return IndexedRecipes(self, positions=[
+                position for position in reversed(included[0])
+                if has_position(bits, position)
+                and position not in skipped
+                and all(position in other for other in others)
+            ])
+
+    def count_tags(self, recipes):
+        """Число рецептов результата filter с каждым тэгом: {tag_id: count}."""
+        with self._lock:
+            if recipes.positions is None:
+                return {
+                    tag_id: (recipes.bitmap & tags).bit_count()
+                    for tag_id, tags in self.tags.items()
+                }
+            counts = {}
+            for tag_id, tags in self.tags.items():
+                bits = to_bytes(tags)
+                counts[tag_id] = sum(
+                    1 for position in recipes.positions
+                    if has_position(bits, position)
+                )
+            return counts
+
+    def get_ids(self, positions):
+        with self._lock:
+            return [self.ids[position] for position in positions]
+
+
+class IndexedRecipes:
+    """
+    Результат фильтрации по индексу для пагинатора: битовая карта
+    или список позиций от новых рецептов к старым. Срез - рецепты
+    страницы, прочитанные из queryset по id в порядке публикации.
+    """
+
+    def __init__(self, index, bitmap=0, positions=None, queryset=None):
+        self.index = index
+        self.bitmap = bitmap
+        self.positions = positions
+        self.queryset = queryset
+
+    def using(self, queryset):
+        return IndexedRecipes(
+            self.index, self.bitmap, self.positions, queryset)
+
+    def __len__(self):
+        if self.positions is not None:
+            return len(self.positions)
+        return self.bitmap.bit_count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start = item.start or 0
+        stop = len(self) if item.stop is None else item.stop
+        if self.positions is not None:
+            positions = self.positions[start:stop]
+        else:
+            positions = list(islice(
+                iter_positions(self.bitmap, start), stop - start))
+        ids = self.index.get_ids(positions)
+        recipes = self.queryset.in_bulk(ids)
+        return [recipes[pk] for pk in ids if pk in recipes]
+
+
+recipe_index = RecipeBitmapIndex()
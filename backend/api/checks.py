@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+from .registries import is_shared_cache
+from .replicas import get_replica_settings
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Битовый индекс рецептов и привязка клиентов к основной базе
+    согласуют процессы через кеш, с кешем в памяти процесса
+    воркеры не видят изменений друг друга.
+    """
+    errors = []
+    if settings.RECIPE_BITMAP_INDEX and not is_shared_cache():
+        errors.append(Error(
+            'RECIPE_BITMAP_INDEX требует общего для процессов кеша.',
+            hint='Задайте REDIS_URL или другой общий бэкенд в CACHES.',
+            id='api.E001',
+        ))
+    if get_replica_settings()['ALIASES'] and not is_shared_cache():
+        errors.append(Error(
+            'Чтение с реплик требует общего для процессов кеша.',
+            hint='Задайте REDIS_URL или другой общий бэкенд в CACHES.',
+            id='api.E002',
+        ))
+    return errors
@@ -1,22 +1,109 @@
+from django.db.models import Count, Exists, OuterRef
 from django_filters import rest_framework as filters
 from rest_framework.filters import SearchFilter
 
-from recipes.models import Recipe, Tag
+from .bitmaps import recipe_index
+from .registries import tag_registry
+from recipes.models import Recipe
+
+RecipeTags = Recipe.tags.through
+
+TAGS_MODES = (
+    ('any', 'Любой из тэгов'),
+    ('all', 'Все тэги'),
+)
+
+
+def tag_choices():
+    return tag_registry.choices()
 
 
 class RecipieFilter(filters.FilterSet):
     is_favorited = filters.BooleanFilter()
     is_in_shopping_cart = filters.BooleanFilter()
-    tags = filters.ModelMultipleChoiceFilter(
-        queryset=Tag.objects.all(),
-        field_name='tags__slug',
-        to_field_name='slug'
+    tags = filters.MultipleChoiceFilter(
+        choices=tag_choices,
+        method='filter_tags',
+    )
+    tags_mode = filters.ChoiceFilter(
+        choices=TAGS_MODES,
+        method='filter_tags_mode',
     )
 
     class Meta:
         model = Recipe
         fields = ['author', 'tags', 'is_favorited', 'is_in_shopping_cart']
 
+    def filter_tags(self, queryset, name, value):
+        """
+        Фильтрует рецепты подзапросами EXISTS к таблице связей:
+        без JOIN рецепты не дублируются и не нужен DISTINCT.
+        tags_mode=all оставляет рецепты со всеми переданными тэгами.
+        """
+        if not value:
+            return queryset
+        tag_ids = [tag_registry.get_by_slug(slug).pk for slug in value]
+        if self.form.cleaned_data.get('tags_mode') == 'all':
+            for tag_id in tag_ids:
+                queryset = queryset.filter(Exists(RecipeTags.objects.filter(
+                    recipe=OuterRef('pk'), tag_id=tag_id)))
+            return queryset
+        return queryset.filter(Exists(RecipeTags.objects.filter(
+            recipe=OuterRef('pk'), tag_id__in=tag_ids)))
+
+    def filter_tags_mode(self, queryset, name, value):
+        return queryset
+
+    def filter_by_index(self, queryset):
+        """
+        Те же фильтры по битовому индексу рецептов в памяти.
+        Возвращает объект для пагинатора, рецепты страницы
+        читаются из queryset. Анонимному пользователю
+        is_favorited и is_in_shopping_cart считают коллекции пустыми.
+        """
+        data = self.form.cleaned_data
+        user_id = self.request.user.pk
+        collections = [
+            (name, user_id, data[field])
+            for name, field in (
+                ('favorite', 'is_favorited'),
+                ('cart', 'is_in_shopping_cart'),
+            )
+            if data.get(field) is not None
+        ]
+        author = data.get('author')
+        return recipe_index.filter(
+            author_id=None if author is None else author.pk,
+            tag_ids=[
+                tag_registry.get_by_slug(slug).pk
+                for slug in data.get('tags') or ()
+            ],
+            tags_mode=data.get('tags_mode') or 'any',
+            collections=collections,
+        ).using(queryset)
+
+    def get_tag_counts(self):
+        """
+        Число рецептов с каждым тэгом при текущих фильтрах одним
+        сгруппированным запросом или по битовому индексу: {tag_id: count}.
+        В режиме any выбранные тэги не учитываются - счётчик показывает,
+        сколько рецептов даст тэг; в режиме all - сколько останется,
+        если добавить тэг к выбранным.
+        """
+        data = self.data.copy()
+        if self.form.cleaned_data.get('tags_mode') != 'all':
+            data.pop('tags', None)
+        filterset = type(self)(data, self.queryset, request=self.request)
+        if recipe_index.is_enabled() and filterset.is_valid():
+            return recipe_index.count_tags(
+                filterset.filter_by_index(self.queryset))
+        recipes = filterset.qs.order_by().values('pk')
+        return dict(
+            RecipeTags.objects.filter(recipe__in=recipes).values(
+                'tag_id').annotate(count=Count('recipe_id')).order_by(
+            ).values_list('tag_id', 'count')
+        )
+
 
 class IngredientsFilter(SearchFilter):
     search_param = 'name'
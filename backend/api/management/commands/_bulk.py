@@ -0,0 +1,70 @@
+from itertools import islice
+
+from django.db import transaction
+
+BATCH_SIZE = 1000
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def bulk_insert(model, objects, batch_size=BATCH_SIZE, progress=None):
+    """
+    Вставляет объекты пачками по batch_size в одной транзакции,
+    пропуская нарушающие уникальность.
+    Возвращает количество добавленных и пропущенных объектов.
+    """
+    total = 0
+    with transaction.atomic():
+        before = model.objects.count()
+        for batch in batched(objects, batch_size):
+            model.objects.bulk_create(batch, ignore_conflicts=True)
+            total += len(batch)
+            if progress is not None:
+                progress.next()
+        inserted = model.objects.count() - before
+    return inserted, total - inserted
+
+
+def upsert(
+    model, key, fields, objects, batch_size=BATCH_SIZE, progress=None,
+    before_create=None,
+):
+    """
+    Добавляет новые объекты и обновляет поля fields у уже существующих
+    (поиск по уникальному полю key), только если значения отличаются.
+    before_create вызывается для каждой пачки новых объектов.
+    Возвращает количество добавленных, обновлённых и неизменных.
+    """
+    total = updated = 0
+    with transaction.atomic():
+        before = model.objects.count()
+        for batch in batched(objects, batch_size):
+            current = model.objects.in_bulk(
+                [getattr(obj, key) for obj in batch], field_name=key)
+            to_create, to_update = [], []
+            for obj in batch:
+                instance = current.get(getattr(obj, key))
+                if instance is None:
+                    to_create.append(obj)
+                    continue
+                if any(
+                    getattr(instance, field) != getattr(obj, field)
+                    for field in fields
+                ):
+                    for field in fields:
+                        setattr(instance, field, getattr(obj, field))
+                    to_update.append(instance)
+            if to_create and before_create is not None:
+                before_create(to_create)
+            model.objects.bulk_create(to_create, ignore_conflicts=True)
+            model.objects.bulk_update(to_update, fields)
+            total += len(batch)
+            updated += len(to_update)
+            if progress is not None:
+                progress.next()
+        inserted = model.objects.count() - before
+    return inserted, updated, total - inserted - updated
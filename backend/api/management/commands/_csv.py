@@ -1,31 +1,15 @@
-from csv import DictReader
+import csv
 
 from django.conf import settings
-from django.db.utils import IntegrityError
-from progress.spinner import LineSpinner
 
-from recipes.models import Ingredients
+INGREDIENTS_PATH = f'{settings.BASE_DIR}/data/ingredients.csv'
 
 
-def load_ingredient():
-    spinner = LineSpinner('Добавляем ингридиенты в базу ')
-    for row in DictReader(
-        open(
-            f'{settings.BASE_DIR}/data/ingredients.csv',
-            'r',
-            encoding='utf8'
-        )
-    ):
-        spinner.next()
-        name, measurement_unit = row.values()
-        try:
-            ingredient = Ingredients(
-                name=name,
-                measurement_unit=measurement_unit,
-            )
-            ingredient.save()
-        except IntegrityError:
-            print(
-                f'"{name},{measurement_unit}" уже есть в базе'
-            )
-    spinner.writeln('✓ Ингредиенты добавлены успешно!\n')
+def read_ingredients(path=INGREDIENTS_PATH):
+    """
+    Построчно читает ингредиенты из csv без заголовка:
+    {название},{единица измерения}
+    """
+    with open(path, 'r', encoding='utf8') as file:
+        for name, measurement_unit in csv.reader(file):
+            yield name, measurement_unit
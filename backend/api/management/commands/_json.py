@@ -1,27 +1,49 @@
 import json
+import re
 
 from django.conf import settings
-from django.db.utils import IntegrityError
-from progress.spinner import LineSpinner
 
-from recipes.models import Ingredients
+INGREDIENTS_PATH = f'{settings.BASE_DIR}/data/ingredients.json'
+CHUNK_SIZE = 64 * 1024
+SEPARATORS = re.compile(r'[\s,]*')
 
 
-def load_ingredient():
-    spinner = LineSpinner('Добавляем ингридиенты в базу ')
-    with open(f'{settings.BASE_DIR}/data/ingredients.json',) as file:
-        ingredients = json.load(file)
-        for item in ingredients:
-            spinner.next()
-            name, measurement_unit = item.values()
+def iter_array(file, chunk_size=CHUNK_SIZE):
+    """
+    Потоково разбирает json-массив верхнего уровня и отдаёт его
+    элементы по одному, не загружая файл в память целиком.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+    started = False
+    for chunk in iter(lambda: file.read(chunk_size), ''):
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            position = SEPARATORS.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Ожидался json-массив')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
             try:
-                ingredient = Ingredients(
-                    name=name,
-                    measurement_unit=measurement_unit,
-                )
-                ingredient.save()
-            except IntegrityError:
-                print(
-                    f'"{name},{measurement_unit}" уже есть в базе'
-                )
-    spinner.writeln('✓ Ингредиенты добавлены успешно!\n')
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            yield item
+    raise ValueError('Неожиданный конец json-массива')
+
+
+def read_ingredients(path=INGREDIENTS_PATH):
+    """
+    Построчно читает ингредиенты из json-массива объектов
+    {"name": ..., "measurement_unit": ...}
+    """
+    with open(path, 'r', encoding='utf8') as file:
+        for item in iter_array(file):
+            yield item['name'], item['measurement_unit']
@@ -0,0 +1,233 @@
+import base64
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+
+from recipes.models import Ingredients, Recipe, Tag
+from users.models import User
+
+BASELINES_PATH = f'{settings.BASE_DIR}/benchmarks.json'
+
+
+def get_image():
+    file = io.BytesIO()
+    Image.new('RGB', (8, 8), '#4DB6AC').save(file, 'PNG')
+    return (
+        'data:image/png;base64,'
+        + base64.b64encode(file.getvalue()).decode()
+    )
+
+
+class Benchmark:
+    """
+    Сценарии запросов к основным эндпоинтам от имени одного
+    пользователя сгенерированного набора данных.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.client.force_authenticate(user=user)
+        self.tags = list(Tag.objects.values_list('id', 'slug')[:2])
+        self.ingredients = list(
+            Ingredients.objects.values_list('id', flat=True)[:30])
+        self.recipe = Recipe.objects.filter(author=user).first()
+        self.ingredient_prefix = Ingredients.objects.values_list(
+            'name', flat=True).first()[:2]
+        self.image = get_image()
+        self.last_page = max(1, (Recipe.objects.count() + 49) // 50)
+        self.created = 0
+
+    def scenarios(self):
+        slugs = '&'.join(f'tags={slug}' for _, slug in self.tags)
+        scenarios = {
+            'recipes_list': self.get('/api/recipes/?limit=50'),
+            'recipes_list_cursor': self.get(
+                '/api/recipes/?pagination=cursor&limit=50'),
+            'recipes_list_deep_page': self.get(
+                f'/api/recipes/?page={self.last_page}&limit=50'),
+            'recipes_list_tags': self.get(f'/api/recipes/?limit=50&{slugs}'),
+            'recipes_list_author': self.get(
+                f'/api/recipes/?limit=50&author={self.user.pk}'),
+            'recipes_list_favorited': self.get(
+                '/api/recipes/?limit=50&is_favorited=1'),
+            'recipes_list_in_cart': self.get(
+                '/api/recipes/?limit=50&is_in_shopping_cart=1'),
+            'users_list': self.get('/api/users/?limit=50'),
+            'subscriptions': self.get(
+                '/api/users/subscriptions/?limit=10&recipes_limit=3'),
+            'ingredients_search': self.get(
+                f'/api/ingredients/?name={self.ingredient_prefix}'),
+            'tags_list': self.get('/api/tags/'),
+            'shopping_cart_download': self.get(
+                '/api/recipes/download_shopping_cart/'),
+            'recipe_create': self.create_recipe,
+        }
+        if self.recipe is not None:
+            scenarios['recipe_detail'] = self.get(
+                f'/api/recipes/{self.recipe.pk}/')
+            scenarios['recipe_update'] = self.update_recipe
+        return scenarios
+
+    def get(self, url):
+        def request():
+            response = self.client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            return response
+        return request
+
+    def get_recipe_data(self, amount):
+        return {
+            'ingredients': [
+                {'id': ingredient_id, 'amount': amount}
+                for ingredient_id in self.ingredients[:15]
+            ],
+            'tags': [tag_id for tag_id, _ in self.tags],
+            'name': f'benchmark recipe {self.created}',
+            'text': 'benchmark',
+            'cooking_time': amount,
+        }
+
+    def create_recipe(self):
+        self.created += 1
+        data = self.get_recipe_data(1)
+        data['image'] = self.image
+        return self.client.post('/api/recipes/', data, format='json')
+
+    def update_recipe(self):
+        self.created += 1
+        data = self.get_recipe_data(self.created % 5 + 1)
+        return self.client.patch(
+            f'/api/recipes/{self.recipe.pk}/', data, format='json')
+
+
+def measure(request, iterations, warmup):
+    for _ in range(warmup):
+        request()
+    timings, queries = [], 0
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = request()
+            timings.append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 400:
+            raise CommandError(
+                f'{response.status_code}: {response.content[:200]}')
+        queries = max(queries, len(context))
+    percentiles = statistics.quantiles(timings, n=100, method='inclusive')
+    return {
+        'p50_ms': round(percentiles[49], 2),
+        'p95_ms': round(percentiles[94], 2),
+        'queries': queries,
+    }
+
+
+def compare(results, baselines, tolerance, queries_tolerance):
+    """Возвращает список регрессий относительно сохранённых значений."""
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        if result['queries'] > baseline['queries'] + queries_tolerance:
+            regressions.append(
+                f'{name}: запросов {result["queries"]}, '
+                f'было {baseline["queries"]}'
+            )
+        if result['p95_ms'] > baseline['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f'{name}: p95 {result["p95_ms"]} мс, '
+                f'было {baseline["p95_ms"]} мс'
+            )
+    return regressions
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет p50/p95 и число SQL запросов основных эндпоинтов на '
+        'данных generate_data и сравнивает с сохранёнными значениями'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', default='load_user_0',
+            help='Пользователь, от имени которого идут запросы')
+        parser.add_argument(
+            '--iterations', type=int, default=20,
+            help='Число замеров каждого сценария, не меньше 2')
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument(
+            '--only', nargs='*', default=(),
+            help='Запустить только перечисленные сценарии')
+        parser.add_argument('--baselines', default=BASELINES_PATH)
+        parser.add_argument(
+            '--save', action='store_true', default=False,
+            help='Сохранить результаты как новые эталонные')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Допустимый рост p95, доля от эталона')
+        parser.add_argument(
+            '--queries-tolerance', type=int, default=0,
+            help='Допустимый рост числа запросов')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 2:
+            raise CommandError(
+                'Для p50/p95 нужно не меньше двух замеров: --iterations 2')
+        user = User.objects.filter(username=options['user']).first()
+        if user is None:
+            raise CommandError(
+                f'Нет пользователя {options["user"]}, '
+                'сначала запустите generate_data'
+            )
+        results = {}
+        # Откат транзакции не удаляет картинки созданных рецептов,
+        # поэтому на время замеров они пишутся во временный каталог.
+        with (
+            tempfile.TemporaryDirectory() as media_root,
+            override_settings(MEDIA_ROOT=media_root),
+            transaction.atomic(),
+        ):
+            benchmark = Benchmark(user)
+            for name, request in benchmark.scenarios().items():
+                if options['only'] and name not in options['only']:
+                    continue
+                results[name] = measure(
+                    request, options['iterations'], options['warmup'])
+                self.stdout.write(
+                    f'{name:<28}{results[name]["p50_ms"]:>10} мс'
+                    f'{results[name]["p95_ms"]:>10} мс'
+                    f'{results[name]["queries"]:>6} запр.'
+                )
+            transaction.set_rollback(True)
+
+        baselines = {}
+        if os.path.exists(options['baselines']):
+            with open(options['baselines'], encoding='utf8') as file:
+                baselines = json.load(file)
+        if options['save']:
+            baselines.setdefault(connection.vendor, {}).update(results)
+            with open(options['baselines'], 'w', encoding='utf8') as file:
+                json.dump(baselines, file, indent=4, sort_keys=True)
+            self.stdout.write(f'✓ Сохранено в {options["baselines"]}')
+            return
+        regressions = compare(
+            results,
+            baselines.get(connection.vendor, {}),
+            options['tolerance'],
+            options['queries_tolerance'],
+        )
+        if regressions:
+            raise CommandError('Регрессии:\n' + '\n'.join(regressions))
+        self.stdout.write('✓ Регрессий нет')
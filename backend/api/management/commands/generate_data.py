@@ -0,0 +1,318 @@
+import os
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from PIL import Image
+from progress.bar import Bar
+
+from ._bulk import BATCH_SIZE, batched
+from api.bitmaps import recipe_index
+from api.registries import ingredients_index, tag_registry
+from recipes.models import (
+    Cart, Favorite, Ingredients, IngredientsAmount, Recipe, Tag,
+)
+from recipes.services import rebuild_cart_totals
+from users.models import Subscribe, User
+
+IMAGES_DIR = 'recipe/placeholders'
+COLORS = (
+    '#E57373', '#F06292', '#BA68C8', '#7986CB', '#4FC3F7',
+    '#4DB6AC', '#AED581', '#FFD54F', '#FF8A65', '#A1887F',
+)
+
+
+def zipf_weights(count):
+    """
+    Накопленные веса распределения Ципфа: немногие авторы
+    и ингредиенты популярны, большинство - редки.
+    """
+    return list(accumulate(1 / rank for rank in range(1, count + 1)))
+
+
+class Command(BaseCommand):
+    help = (
+        'Генерирует воспроизводимый (--seed) набор данных для нагрузочного '
+        'тестирования: пользователей, рецепты, подписки, избранное и корзины'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument(
+            '--ingredients', type=int, default=500,
+            help='Сколько ингредиентов создать, если их нет в базе')
+        parser.add_argument(
+            '--follows', type=int, default=10,
+            help='Среднее число подписок на пользователя')
+        parser.add_argument(
+            '--favorites', type=int, default=20,
+            help='Среднее число избранных рецептов на пользователя')
+        parser.add_argument(
+            '--cart', type=int, default=5,
+            help='Среднее число рецептов в корзине пользователя')
+        parser.add_argument('--images', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--prefix', default='load',
+            help='Префикс имён пользователей и рецептов')
+        parser.add_argument(
+            '--password', default='load_password',
+            help='Пароль всех сгенерированных пользователей')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        self.seed = options['seed']
+        self.rng = random.Random()
+        self.prefix = options['prefix']
+        self.batch_size = options['batch_size']
+
+        tag_ids = self.get_tags()
+        ingredient_ids = self.get_ingredients(options['ingredients'])
+        images = self.create_images(options['images'])
+        user_ids = self.create_users(options['users'], options['password'])
+        recipe_ids = self.create_recipes(
+            options['recipes'], user_ids, images)
+        self.create_recipe_relations(recipe_ids, tag_ids, ingredient_ids)
+        self.create_follows(user_ids, options['follows'])
+        self.create_collections(
+            Favorite, user_ids, recipe_ids, options['favorites'])
+        self.create_collections(Cart, user_ids, recipe_ids, options['cart'])
+        rebuild_cart_totals(
+            User.objects.filter(username__startswith=f'{self.prefix}_user_'))
+        recipe_index.invalidate()
+        self.stdout.write(
+            f'✓ Сгенерировано: пользователей {len(user_ids)}, '
+            f'рецептов {len(recipe_ids)}'
+        )
+
+    def reseed(self, stage):
+        """
+        Своё зерно на каждый этап: результат этапа не зависит
+        от того, что уже есть в базе.
+        """
+        self.rng.seed(f'{self.seed}:{stage}')
+
+    def progress(self, message, total):
+        return Bar(message, max=max(1, total // self.batch_size))
+
+    def sample_counts(self, mean, size):
+        """Количество связей на объект: экспоненциальное со средним mean."""
+        return [
+            min(size, int(self.rng.expovariate(1 / mean)))
+            for _ in range(size)
+        ] if mean > 0 and size > 0 else [0] * size
+
+    def get_tags(self):
+        if not Tag.objects.exists():
+            Tag.objects.bulk_create(
+                Tag(name=f'{self.prefix} tag {number}', color=color,
+                    slug=f'{self.prefix}-tag-{number}')
+                for number, color in enumerate(COLORS[:5])
+            )
+            tag_registry.invalidate()
+        return list(Tag.objects.values_list('id', flat=True))
+
+    def get_ingredients(self, count):
+        self.reseed('ingredients')
+        if not Ingredients.objects.exists():
+            Ingredients.objects.bulk_create(
+                (
+                    Ingredients(
+                        name=f'{self.prefix} ingredient {number}',
+                        measurement_unit=self.rng.choice(('г', 'мл', 'шт')),
+                    )
+                    for number in range(count)
+                ),
+                batch_size=self.batch_size,
+            )
+            ingredients_index.invalidate()
+        ingredient_ids = list(
+            Ingredients.objects.order_by('id').values_list('id', flat=True))
+        self.rng.shuffle(ingredient_ids)
+        return ingredient_ids
+
+    def create_images(self, count):
+        """Небольшой набор картинок, общий для всех рецептов."""
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, IMAGES_DIR),
+                    exist_ok=True)
+        images = []
+        for number in range(max(1, count)):
+            name = f'{IMAGES_DIR}/{self.prefix}_{number}.png'
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            if not os.path.exists(path):
+                color = COLORS[number % len(COLORS)]
+                Image.new('RGB', (64, 64), color).save(path)
+            images.append(name)
+        return images
+
+    def create_users(self, count, password):
+        password = make_password(password)
+        joined = timezone.now() - timedelta(days=365)
+        bar = self.progress('Пользователи', count)
+        for batch in batched(range(count), self.batch_size):
+            User.objects.bulk_create(
+                (
+                    User(
+                        username=f'{self.prefix}_user_{number}',
+                        email=f'{self.prefix}_user_{number}@example.com',
+                        first_name=f'Имя {number}',
+                        last_name=f'Фамилия {number}',
+                        password=password,
+                        date_joined=joined + timedelta(minutes=number),
+                    )
+                    for number in batch
+                ),
+                ignore_conflicts=True,
+            )
+            bar.next()
+        bar.finish()
+        return list(
+            User.objects.filter(
+                username__startswith=f'{self.prefix}_user_',
+            ).order_by('id').values_list('id', flat=True)
+        )
+
+    def create_recipes(self, count, user_ids, images):
+        self.reseed('recipes')
+        authors_weights = zipf_weights(len(user_ids))
+        published = timezone.now() - timedelta(days=365)
+        step = timedelta(days=365) / max(1, count)
+        bar = self.progress('Рецепты', count)
+        for batch in batched(range(count), self.batch_size):
+            recipes = Recipe.objects.bulk_create(
+                (
+                    Recipe(
+                        author_id=author_id,
+                        name=f'{self.prefix} recipe {number}',
+                        image=self.rng.choice(images),
+                        text=f'Текст рецепта {number}',
+                        cooking_time=self.rng.randint(5, 180),
+                    )
+                    for number, author_id in zip(
+                        batch,
+                        self.rng.choices(
+                            user_ids,
+                            cum_weights=authors_weights,
+                            k=len(batch),
+                        ),
+                    )
+                ),
+                ignore_conflicts=True,
+            )
+            for number, recipe in zip(batch, recipes):
+                recipe.publication_date = published + step * number
+            Recipe.objects.bulk_update(
+                self.with_pks(recipes), ('publication_date',))
+            bar.next()
+        bar.finish()
+        return list(
+            Recipe.objects.filter(
+                name__startswith=f'{self.prefix} recipe ',
+            ).order_by('id').values_list('id', flat=True)
+        )
+
+    def with_pks(self, recipes):
+        """
+        bulk_create с ignore_conflicts не возвращает id,
+        поэтому подставляем их по уникальному имени.
+        """
+        pks = dict(
+            Recipe.objects.filter(
+                name__in=[recipe.name for recipe in recipes],
+            ).values_list('name', 'id')
+        )
+        for recipe in recipes:
+            recipe.pk = pks[recipe.name]
+        return recipes
+
+    def create_recipe_relations(self, recipe_ids, tag_ids, ingredient_ids):
+        self.reseed('relations')
+        RecipeTags = Recipe.tags.through
+        ingredients_weights = zipf_weights(len(ingredient_ids))
+        bar = self.progress('Тэги и ингредиенты', len(recipe_ids))
+        for batch in batched(recipe_ids, self.batch_size):
+            tags, amounts = [], []
+            for recipe_id in batch:
+                for tag_id in self.rng.sample(
+                    tag_ids, self.rng.randint(1, min(3, len(tag_ids)))
+                ):
+                    tags.append(RecipeTags(recipe_id=recipe_id, tag_id=tag_id))
+                chosen = set(self.rng.choices(
+                    ingredient_ids,
+                    cum_weights=ingredients_weights,
+                    k=self.rng.randint(3, 12),
+                ))
+                for ingredient_id in chosen:
+                    amounts.append(IngredientsAmount(
+                        recipe_id=recipe_id,
+                        ingredients_id=ingredient_id,
+                        amount=self.rng.randint(1, 500),
+                    ))
+            RecipeTags.objects.bulk_create(tags, ignore_conflicts=True)
+            IngredientsAmount.objects.bulk_create(
+                amounts, ignore_conflicts=True)
+            bar.next()
+        bar.finish()
+
+    def create_follows(self, user_ids, mean):
+        self.reseed('follows')
+        authors_weights = zipf_weights(len(user_ids))
+        counts = self.sample_counts(mean, len(user_ids))
+        bar = self.progress('Подписки', len(user_ids))
+        for batch in batched(zip(user_ids, counts), self.batch_size):
+            Subscribe.objects.bulk_create(
+                (
+                    Subscribe(user_id=user_id, author_id=author_id)
+                    for user_id, count in batch
+                    for author_id in set(self.rng.choices(
+                        user_ids, cum_weights=authors_weights, k=count))
+                    if author_id != user_id
+                ),
+                ignore_conflicts=True,
+            )
+            bar.next()
+        bar.finish()
+
+    def create_collections(self, model, user_ids, recipe_ids, mean):
+        """Избранное или корзины: по одному объекту model на пользователя."""
+        self.reseed(model._meta.model_name)
+        Through = model.recipes.through
+        owner_field = f'{model._meta.model_name}_id'
+        recipes_weights = zipf_weights(len(recipe_ids))
+        counts = self.sample_counts(mean, len(user_ids))
+        bar = self.progress(model._meta.verbose_name_plural, len(user_ids))
+        for batch in batched(zip(user_ids, counts), self.batch_size):
+            batch = [(user_id, count) for user_id, count in batch if count]
+            existing = dict(
+                model.objects.filter(
+                    user_id__in=[user_id for user_id, _ in batch],
+                ).values_list('user_id', 'id')
+            )
+            model.objects.bulk_create(
+                model(user_id=user_id)
+                for user_id, _ in batch if user_id not in existing
+            )
+            existing = dict(
+                model.objects.filter(
+                    user_id__in=[user_id for user_id, _ in batch],
+                ).values_list('user_id', 'id')
+            )
+            Through.objects.bulk_create(
+                (
+                    Through(**{
+                        owner_field: existing[user_id],
+                        'recipe_id': recipe_id,
+                    })
+                    for user_id, count in batch
+                    for recipe_id in set(self.rng.choices(
+                        recipe_ids, cum_weights=recipes_weights, k=count))
+                ),
+                ignore_conflicts=True,
+            )
+            bar.next()
+        bar.finish()
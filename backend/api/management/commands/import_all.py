@@ -1,15 +1,50 @@
+import hashlib
+
+from django.conf import settings
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 
+from api.models import DataSource
+
+CHUNK_SIZE = 64 * 1024
+SOURCES = (
+    ('ingredients.csv', 'import_ingredient'),
+    ('users.csv', 'import_user'),
+    ('tags.csv', 'import_tag'),
+)
+
+
+def get_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
 
 class Command(BaseCommand):
-    help = 'Загружает данные из csv или json'
+    help = (
+        'Загружает данные из csv. Файлы, не изменившиеся с прошлой '
+        'загрузки, пропускаются, -f (--force) загружает все'
+    )
 
     def handle(self, *args, **options):
-        from .import_ingredient import Command
-        Command.handle(self)
-
-        from .import_user import Command
-        Command.handle(self)
+        loaded = dict(DataSource.objects.values_list('name', 'checksum'))
+        for name, command in SOURCES:
+            path = f'{settings.BASE_DIR}/data/{name}'
+            checksum = get_checksum(path)
+            if not options['force'] and loaded.get(name) == checksum:
+                self.stdout.write(f'✓ {name} не изменился, пропускаем')
+                continue
+            call_command(command, path=path, stdout=self.stdout)
+            DataSource.objects.update_or_create(
+                name=name, defaults={'checksum': checksum})
 
-        from .import_tag import Command
-        Command.handle(self)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-f',
+            '--force',
+            action='store_true',
+            default=False,
+            help='Загрузить файлы даже без изменений'
+        )
@@ -1,4 +1,9 @@
 from django.core.management.base import BaseCommand
+from progress.spinner import LineSpinner
+
+from ._bulk import BATCH_SIZE, bulk_insert
+from api.registries import ingredients_index
+from recipes.models import Ingredients
 
 
 class Command(BaseCommand):
@@ -6,11 +11,26 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         if options.get('json'):
-            from ._json import load_ingredient
-            load_ingredient()
+            from ._json import INGREDIENTS_PATH, read_ingredients
         else:
-            from ._csv import load_ingredient
-            load_ingredient()
+            from ._csv import INGREDIENTS_PATH, read_ingredients
+        path = options.get('path') or INGREDIENTS_PATH
+        spinner = LineSpinner('Добавляем ингридиенты в базу ')
+        inserted, skipped = bulk_insert(
+            Ingredients,
+            (
+                Ingredients(name=name, measurement_unit=measurement_unit)
+                for name, measurement_unit in read_ingredients(path)
+            ),
+            options.get('batch_size') or BATCH_SIZE,
+            spinner,
+        )
+        ingredients_index.invalidate()
+        spinner.finish()
+        self.stdout.write(
+            f'✓ Ингредиенты добавлены успешно! Добавлено: {inserted}, '
+            f'уже были в базе: {skipped}'
+        )
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -20,3 +40,15 @@ class Command(BaseCommand):
             default=False,
             help='Загрузить ингридиенты из json'
         )
+        parser.add_argument(
+            '-p',
+            '--path',
+            help='Путь к файлу вместо data/ingredients.csv|json'
+        )
+        parser.add_argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help='Количество строк в одной вставке'
+        )
@@ -2,35 +2,51 @@ from csv import DictReader
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.utils import IntegrityError
 from progress.spinner import LineSpinner
 
+from ._bulk import upsert
+from api.registries import tag_registry
 from recipes.models import Tag
 
+TAGS_PATH = f'{settings.BASE_DIR}/data/tags.csv'
+
+
+def read_tags(path=TAGS_PATH):
+    """
+    Построчно читает тэги из csv, первая строка - заголовок:
+    {название},{цвет},{slug}
+    """
+    with open(path, 'r', encoding='utf8') as file:
+        for row in DictReader(file):
+            yield row.values()
+
 
 class Command(BaseCommand):
-    help = 'Загружает данные из csv или json'
+    help = 'Загружает тэги из csv'
 
     def handle(self, *args, **options):
         spinner = LineSpinner('Добавляем тэги в базу ')
-        for row in DictReader(
-            open(
-                f'{settings.BASE_DIR}/data/tags.csv',
-                'r',
-                encoding='utf8'
-            )
-        ):
-            spinner.next()
-            name, color, slug = row.values()
-            try:
-                tag = Tag(
-                    name=name,
-                    color=color,
-                    slug=slug,
-                )
-                tag.save()
-            except IntegrityError:
-                print(
-                    f'Тэг "{name}" уже есть в базе'
-                )
-        spinner.writeln('✓ Тэги добавлены успешно!\n')
+        inserted, updated, unchanged = upsert(
+            Tag,
+            'slug',
+            ('name', 'color'),
+            (
+                Tag(name=name, color=color, slug=slug)
+                for name, color, slug in read_tags(
+                    options.get('path') or TAGS_PATH)
+            ),
+            progress=spinner,
+        )
+        tag_registry.invalidate()
+        spinner.finish()
+        self.stdout.write(
+            f'✓ Тэги добавлены успешно! Добавлено: {inserted}, '
+            f'обновлено: {updated}, без изменений: {unchanged}'
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p',
+            '--path',
+            help='Путь к файлу вместо data/tags.csv'
+        )
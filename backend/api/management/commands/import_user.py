@@ -1,52 +1,107 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from csv import DictReader
+from functools import partial
 
+import django
 from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand
-from django.db.utils import IntegrityError
 from django.utils.crypto import get_random_string
 from progress.spinner import LineSpinner
 
+from ._bulk import BATCH_SIZE, upsert
 from users.models import User
 
+USERS_PATH = f'{settings.BASE_DIR}/data/users.csv'
+
+
+def read_users(path=USERS_PATH):
+    """
+    Построчно читает пользователей из csv с заголовком:
+    username,email,first_name,last_name
+    """
+    with open(path, 'r', encoding='utf8') as file:
+        for row in DictReader(file):
+            yield row.values()
+
+
+def set_passwords(users, hash_passwords=map):
+    """
+    Задаёт новым пользователям случайные пароли.
+    Хеширует через hash_passwords - map или map пула процессов.
+    """
+    hashes = hash_passwords(
+        make_password, [get_random_string(10) for _ in users])
+    for user, password in zip(users, hashes):
+        user.password = password
+
 
 class Command(BaseCommand):
-    help = 'Загружает данные из csv или json'
+    help = 'Загружает пользователей из csv'
 
     def handle(self, *args, **options):
         spinner = LineSpinner('Добавляем пользователей в базу ')
         spinner.next()
-        super = User(
-            username='admin',
-            email='admin@admin.ru',
-            first_name='admin',
-            last_name='admin',
-            is_staff=True,
-            is_superuser=True,
-        )
-        password = 'admin'
-        super.set_password(password)
-        super.save()
+        if not User.objects.filter(username='admin').exists():
+            super = User(
+                username='admin',
+                email='admin@admin.ru',
+                first_name='admin',
+                last_name='admin',
+                is_staff=True,
+                is_superuser=True,
+            )
+            password = 'admin'
+            super.set_password(password)
+            super.save()
         spinner.next()
-        for row in DictReader(
-            open(
-                f'{settings.BASE_DIR}/data/users.csv',
-                'r',
-                encoding='utf8'
+        workers = options.get('workers') or os.cpu_count()
+        batch_size = options.get('batch_size') or BATCH_SIZE
+        with ProcessPoolExecutor(workers, initializer=django.setup) as pool:
+            hash_passwords = partial(
+                pool.map, chunksize=max(1, batch_size // (workers * 4)))
+            inserted, updated, unchanged = upsert(
+                User,
+                'username',
+                ('email', 'first_name', 'last_name'),
+                (
+                    User(
+                        username=username,
+                        email=email,
+                        first_name=first_name,
+                        last_name=last_name,
+                    )
+                    for username, email, first_name, last_name in read_users(
+                        options.get('path') or USERS_PATH)
+                ),
+                batch_size,
+                spinner,
+                partial(set_passwords, hash_passwords=hash_passwords),
             )
-        ):
-            username, email, first_name, last_name = row.values()
-            try:
-                user = User(
-                    username=username,
-                    email=email,
-                    first_name=first_name,
-                    last_name=last_name,
-                )
-                user.set_password(get_random_string(10))
-                user.save()
-                spinner.next()
-            except IntegrityError:
-                print(
-                    f'Юзер "{username}" уже есть в базе'
-                )
-        spinner.writeln('✓ Пользователи добавлены успешно!\n')
+        spinner.finish()
+        self.stdout.write(
+            f'✓ Пользователи добавлены успешно! Добавлено: {inserted}, '
+            f'обновлено: {updated}, без изменений: {unchanged}'
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p',
+            '--path',
+            help='Путь к файлу вместо data/users.csv'
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Количество процессов для хеширования паролей'
+        )
+        parser.add_argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help='Количество строк в одной вставке'
+        )
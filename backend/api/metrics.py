@@ -0,0 +1,267 @@
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from django.conf import settings
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Metric:
+    """
+    Метрика с набором меток. Значения хранятся в словаре
+    по кортежу значений меток; блокировка у каждой метрики своя
+    и держится только на время изменения одного значения.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                [list(key), value] for key, value in self.values.items()
+            ]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    @staticmethod
+    def merge(first, second):
+        return first + second
+
+    def render(self, key, value):
+        yield self.name, key, value
+
+
+class Histogram(Metric):
+    """
+    Гистограмма: количество наблюдений в каждом интервале
+    (последний - выше всех границ), их сумма и количество.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[position] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                [list(key), list(counts)]
+                for key, counts in self.values.items()
+            ]
+
+    @staticmethod
+    def merge(first, second):
+        return [a + b for a, b in zip(first, second)]
+
+    def render(self, key, counts):
+        total = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            total += count
+            yield f'{self.name}_bucket', (*key, ('le', bound)), total
+        yield f'{self.name}_sum', key, counts[-1]
+        yield f'{self.name}_count', key, total
+
+
+class Registry:
+    """
+    Метрики процесса. При нескольких воркерах gunicorn каждый процесс
+    не чаще раза в settings.METRICS_FLUSH_INTERVAL секунд сохраняет
+    свои значения в файл <pid>.json каталога settings.METRICS_DIR,
+    а эндпоинт метрик суммирует файлы всех процессов.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.flushed = 0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=()):
+        return self.register(
+            Histogram(name, documentation, labels, buckets))
+
+    def snapshot(self):
+        return {
+            name: metric.snapshot() for name, metric in self.metrics.items()
+        }
+
+    def get_path(self):
+        return os.path.join(settings.METRICS_DIR, f'{os.getpid()}.json')
+
+    def flush(self, force=False):
+        """Сохраняет значения процесса в файл, если пора."""
+        if not settings.METRICS_DIR:
+            return
+        now = time.monotonic()
+        if not force and now - self.flushed < settings.METRICS_FLUSH_INTERVAL:
+            return
+        self.flushed = now
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = self.get_path()
+        with open(f'{path}.tmp', 'w', encoding='utf8') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        """Значения всех процессов: {имя метрики: {метки: значение}}."""
+        snapshots = [self.snapshot()]
+        if settings.METRICS_DIR:
+            self.flush(force=True)
+            snapshots = []
+            pattern = os.path.join(settings.METRICS_DIR, '*.json')
+            for path in glob.glob(pattern):
+                try:
+                    with open(path, encoding='utf8') as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+        collected = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                for key, value in values:
+                    key = tuple(zip(metric.labels, key))
+                    current = collected[name].get(key)
+                    collected[name][key] = (
+                        value if current is None
+                        else metric.merge(current, value)
+                    )
+        return collected
+
+    def render(self):
+        """Текстовый формат Prometheus."""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for key in sorted(values):
+                for sample, labels, value in metric.render(key, values[key]):
+                    lines.append(f'{sample}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"'),
+        )
+        for name, value in labels
+    ) + '}'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'foodgram_http_request_duration_seconds',
+    'Время обработки запроса',
+    ('route', 'method', 'status'),
+    DURATION_BUCKETS,
+)
+RESPONSE_BYTES = registry.histogram(
+    'foodgram_http_response_size_bytes',
+    'Размер ответа',
+    ('route',),
+    SIZE_BUCKETS,
+)
+DB_QUERIES = registry.histogram(
+    'foodgram_db_queries',
+    'SQL запросов на запрос',
+    ('route',),
+    COUNT_BUCKETS,
+)
+DB_SECONDS = registry.histogram(
+    'foodgram_db_duration_seconds',
+    'Время SQL запросов на запрос',
+    ('route',),
+    DURATION_BUCKETS,
+)
+SERIALIZER_SECONDS = registry.histogram(
+    'foodgram_serializer_duration_seconds',
+    'Время сериализации ответа',
+    ('serializer',),
+    DURATION_BUCKETS,
+)
+CACHE_REQUESTS = registry.counter(
+    'foodgram_cache_requests_total',
+    'Обращения к кешам в памяти по результату (hit, miss)',
+    ('cache', 'result'),
+)
+WRITES = registry.counter(
+    'foodgram_writes_total',
+    'Изменения избранного, корзин и подписок',
+    ('model', 'action'),
+)
+
+
+def timed_representation(serializer):
+    """
+    Подменяет to_representation экземпляра сериализатора,
+    чтобы время сериализации ответа попадало в метрики.
+    """
+    to_representation = serializer.to_representation
+    name = type(getattr(serializer, 'child', serializer)).__name__
+
+    @wraps(to_representation)
+    def wrapper(instance):
+        started = time.perf_counter()
+        try:
+            return to_representation(instance)
+        finally:
+            SERIALIZER_SECONDS.observe(
+                time.perf_counter() - started, serializer=name)
+
+    serializer.to_representation = wrapper
+    return serializer
+
+
+class SerializerMetricsMixin:
+    """Время сериализации ответов вьюсета попадает в метрики."""
+
+    def get_serializer(self, *args, **kwargs):
+        return timed_representation(super().get_serializer(*args, **kwargs))
@@ -0,0 +1,321 @@
+import logging
+import os
+import random
+import sys
+import time
+import traceback
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .metrics import (
+    DB_QUERIES, DB_SECONDS, REQUEST_SECONDS, RESPONSE_BYTES, registry,
+)
+from .profiling import StackSampler, get_profiling_settings
+from .replicas import (
+    choose_replica, get_pin_key, get_replica, get_replica_settings, is_pinned,
+    pin, reset, use_replica,
+)
+
+logger = logging.getLogger('api.queries')
+
+QUERY_BUDGET = {
+    'DEFAULT': 30,
+    'REPEATED': 10,
+    'VIEWS': {},
+}
+
+
+def get_budget_settings():
+    return {**QUERY_BUDGET, **getattr(settings, 'QUERY_BUDGET', {})}
+
+
+def get_view_name(request):
+    """
+    Имя обработчика запроса: `ViewSet.action` для вьюсетов,
+    имя маршрута для остальных представлений.
+    """
+    match = request.resolver_match
+    if match is None:
+        return request.path
+    actions = getattr(match.func, 'actions', None)
+    if actions and request.method.lower() in actions:
+        return (
+            f'{match.func.cls.__name__}.{actions[request.method.lower()]}'
+        )
+    return match.view_name
+
+
+def get_call_site():
+    """Ближайший к запросу кадр стека из кода проекта."""
+    base_dir = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()):
+        if (
+            frame.filename.startswith(base_dir)
+            and frame.filename != __file__
+            and 'site-packages' not in frame.filename
+        ):
+            return (
+                f'{os.path.relpath(frame.filename, base_dir)}:'
+                f'{frame.lineno} in {frame.name}'
+            )
+    return None
+
+
+class QueryCollector:
+    """
+    Обёртка над выполнением SQL (connection.execute_wrapper):
+    считает запросы, их суммарное время и повторы одинаковых
+    по форме запросов.
+    Место вызова запоминается только у запроса, который повторился
+    `repeated` раз, чтобы не разбирать стек на каждом запросе.
+    """
+
+    def __init__(self, repeated):
+        self.repeated = repeated
+        self.count = 0
+        self.duration = 0
+        self.shapes = Counter()
+        self.call_sites = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.shapes[sql] += 1
+            if self.shapes[sql] == self.repeated:
+                self.call_sites[sql] = get_call_site()
+
+    def get_repeated(self):
+        """Повторяющиеся запросы: [(sql, количество, место вызова)]."""
+        return [
+            (sql, self.shapes[sql], call_site)
+            for sql, call_site in self.call_sites.items()
+        ]
+
+
+@contextmanager
+def collect_queries(collector):
+    """Передаёт collector все SQL запросы всех подключений."""
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(collector))
+        yield collector
+
+
+class MetricsMiddleware:
+    """
+    Время обработки, размер ответа и SQL запросы каждого запроса
+    в метриках Prometheus по обработчику (см. api.metrics); у потоковых
+    ответов - после чтения ответа.
+    Ставится перед QueryBudgetMiddleware, от которого берёт
+    количество и время SQL запросов.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        if response.streaming:
+            # Время, размер и запросы потокового ответа известны
+            # только после его чтения.
+            response.streaming_content = self.stream(
+                response.streaming_content, request, response, started)
+        else:
+            self.observe(request, response, started, len(response.content))
+        return response
+
+    def stream(self, content, request, response, started):
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.observe(request, response, started, size)
+
+    def observe(self, request, response, started, size):
+        duration = time.perf_counter() - started
+        route = (
+            get_view_name(request) if request.resolver_match
+            else 'unmatched'
+        )
+        REQUEST_SECONDS.observe(
+            duration,
+            route=route,
+            method=request.method,
+            status=response.status_code,
+        )
+        RESPONSE_BYTES.observe(size, route=route)
+        collector = getattr(request, '_query_collector', None)
+        if collector is not None:
+            DB_QUERIES.observe(collector.count, route=route)
+            DB_SECONDS.observe(collector.duration, route=route)
+        registry.flush()
+
+
+class QueryBudgetMiddleware:
+    """
+    Считает SQL запросы и время работы с базой для каждого запроса.
+    В режиме DEBUG отдаёт их в заголовках X-Query-Count, X-Query-Time
+    и X-View; в лог api.queries пишет превышения бюджета обработчика
+    (settings.QUERY_BUDGET) и повторяющиеся запросы (N+1). У потоковых
+    ответов запросы считаются до конца чтения ответа.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        budget = get_budget_settings()
+        collector = QueryCollector(budget['REPEATED'])
+        with collect_queries(collector):
+            response = self.get_response(request)
+        request._query_collector = collector
+
+        view = get_view_name(request)
+        if settings.DEBUG:
+            response['X-View'] = view
+        if response.streaming:
+            # Потоковый ответ читает базу уже после выхода из
+            # middleware: запросы считаются до конца чтения ответа,
+            # поэтому заголовков с их числом у него нет.
+            response.streaming_content = self.stream(
+                response.streaming_content, request, collector, budget)
+            return response
+        if settings.DEBUG:
+            response['X-Query-Count'] = collector.count
+            response['X-Query-Time'] = round(collector.duration * 1000, 2)
+        self.report(request, collector, budget)
+        return response
+
+    def stream(self, content, request, collector, budget):
+        with collect_queries(collector):
+            yield from content
+        self.report(request, collector, budget)
+
+    def report(self, request, collector, budget):
+        view = get_view_name(request)
+        duration = round(collector.duration * 1000, 2)
+        limit = budget['VIEWS'].get(view, budget['DEFAULT'])
+        if collector.count > limit:
+            logger.warning(
+                '%s %s (%s): %s SQL запросов за %s мс, бюджет %s',
+                request.method, request.path, view,
+                collector.count, duration, limit,
+            )
+        for sql, count, call_site in collector.get_repeated():
+            logger.warning(
+                '%s %s (%s): запрос повторён %s раз, %s\n%s',
+                request.method, request.path, view,
+                count, call_site, sql,
+            )
+
+
+def is_staff_request(request):
+    """
+    Сделан ли запрос staff пользователем. Middleware выполняется
+    до представления, поэтому токен проверяется здесь аутентификацией DRF.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_staff:
+        authenticators = [
+            authenticator()
+            for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+        ]
+        try:
+            user = Request(request, authenticators=authenticators).user
+        except APIException:
+            return False
+    return user is not None and user.is_staff
+
+
+class ProfilingMiddleware:
+    """
+    Профилирует долю запросов settings.PROFILING['SAMPLE_RATE']
+    и запросы с заголовком PROFILING['HEADER'] от staff пользователей.
+    Стеки сохраняются по обработчикам в PROFILING['DIR']
+    и скачиваются со страницы /admin/profiles/.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profiling = get_profiling_settings()
+        requested = (
+            profiling['HEADER'] in request.headers
+            and is_staff_request(request)
+        )
+        if not requested and random.random() >= profiling['SAMPLE_RATE']:
+            return self.get_response(request)
+        sampler = StackSampler(profiling['INTERVAL'])
+        sampler.start(sys._getframe())
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+        sampler.save(get_view_name(request))
+        return response
+
+
+class ReplicaMiddleware:
+    """
+    Отправляет чтения безопасных запросов к обработчикам из
+    settings.REPLICA['VIEWS'] в случайную реплику из REPLICA['ALIASES'].
+    После записи клиент на REPLICA['PIN_SECONDS'] секунд
+    привязывается к основной базе.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset()
+        try:
+            response = self.get_response(request)
+        finally:
+            replica = get_replica()
+            wrote = reset()
+        if response.streaming:
+            # Потоковый ответ читает базу уже после выхода из
+            # middleware, выбранная база сохраняется до конца чтения.
+            response.streaming_content = self.stream(
+                response.streaming_content, request,
+                None if wrote else replica, wrote,
+            )
+        elif wrote:
+            pin(get_pin_key(request))
+        return response
+
+    def stream(self, content, request, replica, wrote):
+        if replica is not None:
+            use_replica(replica)
+        try:
+            yield from content
+        finally:
+            if reset() or wrote:
+                pin(get_pin_key(request))
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (
+            request.method not in ('GET', 'HEAD', 'OPTIONS')
+            or get_view_name(request)
+            not in get_replica_settings()['VIEWS']
+            or is_pinned(get_pin_key(request))
+        ):
+            return None
+        replica = choose_replica()
+        if replica is not None:
+            use_replica(replica)
+        return None
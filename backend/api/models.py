@@ -0,0 +1,30 @@
+from django.db import models
+
+
+class DataSource(models.Model):
+    """
+    Отпечаток загруженного файла из data/. import_all пропускает
+    файлы, контрольная сумма которых не изменилась.
+    """
+    name = models.CharField(
+        unique=True,
+        max_length=200,
+        verbose_name='Файл',
+    )
+    checksum = models.CharField(
+        max_length=64,
+        verbose_name='Контрольная сумма',
+        help_text='sha256 содержимого файла.',
+    )
+    loaded_at = models.DateTimeField(
+        'Дата загрузки',
+        auto_now=True,
+    )
+
+    class Meta:
+        ordering = ('name',)
+        verbose_name = 'Загруженный файл'
+        verbose_name_plural = 'Загруженные файлы'
+
+    def __str__(self):
+        return self.name
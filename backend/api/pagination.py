@@ -1,4 +1,4 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 class LimitPageNumberPagination(PageNumberPagination):
@@ -10,3 +10,46 @@ class LimitPageNumberPagination(PageNumberPagination):
     http://api.example.org/accounts/?page=4&limit=100
     """
     page_size_query_param = 'limit'
+
+
+class LimitCursorPagination(CursorPagination):
+    """
+    Keyset pagination: no COUNT(*) and no OFFSET, so deep pages cost
+    the same as the first one. Ordering is taken from the view's
+    `cursor_ordering`. For example:
+
+    http://api.example.org/accounts/?pagination=cursor&limit=100
+    http://api.example.org/accounts/?cursor=cD0yMDIy&limit=100
+    """
+    page_size_query_param = 'limit'
+
+    def get_ordering(self, request, queryset, view):
+        return getattr(view, 'cursor_ordering', self.ordering)
+
+
+class PageNumberOrCursorPagination:
+    """
+    Page number pagination by default, cursor pagination when
+    requested with `?pagination=cursor` or when following a cursor link.
+    """
+    mode_query_param = 'pagination'
+    cursor_mode = 'cursor'
+
+    def __init__(self):
+        self.paginator = LimitPageNumberPagination()
+
+    def __getattr__(self, name):
+        return getattr(self.paginator, name)
+
+    def is_cursor_requested(self, request):
+        return (
+            request.query_params.get(self.mode_query_param)
+            == self.cursor_mode
+            or LimitCursorPagination.cursor_query_param
+            in request.query_params
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.is_cursor_requested(request):
+            self.paginator = LimitCursorPagination()
+        return self.paginator.paginate_queryset(queryset, request, view)
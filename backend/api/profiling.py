@@ -0,0 +1,121 @@
+import os
+import re
+import sys
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+PROFILING = {
+    'SAMPLE_RATE': 0,
+    'HEADER': 'X-Profile',
+    'INTERVAL': 0.005,
+    'DIR': None,
+    'MAX_BYTES': 10 * 1024 * 1024,
+}
+
+
+def get_profiling_settings():
+    return {**PROFILING, **getattr(settings, 'PROFILING', {})}
+
+
+def get_profiles_dir():
+    return (
+        get_profiling_settings()['DIR']
+        or os.path.join(settings.BASE_DIR, 'profiles')
+    )
+
+
+def get_profile_path(endpoint):
+    name = re.sub(r'[^\w.-]', '_', endpoint).strip('_') or 'root'
+    return os.path.join(get_profiles_dir(), f'{name}.folded')
+
+
+def get_frame_name(frame):
+    return f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}'
+
+
+class StackSampler:
+    """
+    Снимает стек потока запроса каждые `interval` секунд
+    из отдельного потока и считает одинаковые стеки.
+    Кадры выше `root` (сервер, middleware) отбрасываются.
+    Результат - строки в формате folded stacks для flamegraph.pl
+    и speedscope: `кадр;кадр;кадр количество`.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def start(self, root):
+        self.root = root
+        self.thread_id = threading.get_ident()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root:
+                stack.append(get_frame_name(frame))
+                frame = frame.f_back
+            if stack and not self.stopped.is_set():
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def save(self, endpoint):
+        """
+        Дописывает стеки в файл обработчика. Запись одним вызовом
+        в режиме добавления, поэтому файлы общие для всех воркеров.
+        Файл больше PROFILING['MAX_BYTES'] переименовывается
+        в `.folded.1` (прежний такой файл удаляется) и начинается заново.
+        """
+        if not self.stacks:
+            return
+        os.makedirs(get_profiles_dir(), exist_ok=True)
+        path = get_profile_path(endpoint)
+        try:
+            if os.path.getsize(path) >= get_profiling_settings()['MAX_BYTES']:
+                os.replace(path, f'{path}.1')
+        except OSError:
+            pass
+        with open(path, 'a', encoding='utf8') as file:
+            file.write(''.join(
+                f'{stack} {count}\n' for stack, count in self.stacks.items()
+            ))
+
+
+def list_profiles():
+    """Файлы профилей: [(имя, размер)]."""
+    directory = get_profiles_dir()
+    if not os.path.isdir(directory):
+        return []
+    return [
+        (name, os.path.getsize(os.path.join(directory, name)))
+        for name in sorted(os.listdir(directory))
+        if name.endswith('.folded')
+    ]
+
+
+def read_profile(name):
+    """
+    Возвращает профиль обработчика с просуммированными
+    одинаковыми стеками или None, если такого файла нет.
+    """
+    if name not in dict(list_profiles()):
+        return None
+    stacks = Counter()
+    with open(os.path.join(get_profiles_dir(), name), encoding='utf8') as file:
+        for line in file:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return ''.join(
+        f'{stack} {count}\n' for stack, count in sorted(stacks.items())
+    )
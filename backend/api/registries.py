@@ -0,0 +1,160 @@
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+
+from .metrics import CACHE_REQUESTS
+from recipes.models import Ingredients, Tag
+
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def is_shared_cache():
+    """Виден ли кеш по умолчанию всем процессам (воркерам gunicorn)."""
+    return settings.CACHES['default']['BACKEND'] not in LOCAL_CACHE_BACKENDS
+
+
+class ModelSnapshot:
+    """
+    Снимок небольшой, редко меняющейся таблицы в памяти процесса.
+    Сохранение или удаление объекта увеличивает версию в кеше Django,
+    снимок перестраивается при следующем обращении. При общем для
+    воркеров кеше изменения подхватывают все процессы, с кешем в памяти
+    процесса снимок дополнительно перестраивается не реже раза
+    в settings.SNAPSHOT_TTL секунд.
+    Версия читается из кеша не чаще раза в
+    settings.SNAPSHOT_CHECK_INTERVAL секунд: поиск тэгов по одному
+    в фильтрах и сериализаторах не ходит в Redis на каждый тэг.
+    """
+    model = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = None
+        self._built = 0
+        self._latest = 0
+        self._checked = None
+        post_save.connect(self.invalidate, sender=self.model, weak=False)
+        post_delete.connect(self.invalidate, sender=self.model, weak=False)
+
+    @property
+    def version_key(self):
+        return f'snapshot-version:{self.model._meta.label_lower}'
+
+    def build(self, objects):
+        raise NotImplementedError
+
+    def get_version(self):
+        now = time.monotonic()
+        if (
+            self._checked is None
+            or now - self._checked >= settings.SNAPSHOT_CHECK_INTERVAL
+        ):
+            self._latest = cache.get(self.version_key, 0)
+            self._checked = now
+        return self._latest
+
+    def get_data(self):
+        version = self.get_version()
+        data = self._data
+        name = self.model._meta.model_name
+        expired = (
+            not is_shared_cache()
+            and time.monotonic() - self._built >= settings.SNAPSHOT_TTL
+        )
+        if data is None or version != self._version or expired:
+            CACHE_REQUESTS.inc(cache=name, result='miss')
+            with self._lock:
+                # С отстающей реплики снимок остался бы устаревшим
+                # под новой версией, поэтому читаем основную базу.
+                data = self.build(list(
+                    self.model.objects.using(DEFAULT_DB_ALIAS)))
+                self._data, self._version = data, version
+                self._built = time.monotonic()
+        else:
+            CACHE_REQUESTS.inc(cache=name, result='hit')
+        return data
+
+    def invalidate(self, **kwargs):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, None)
+        self._data = None
+        self._checked = None
+
+
+class IngredientsIndex(ModelSnapshot):
+    """
+    Префиксный индекс ингредиентов для автодополнения:
+    отсортированный список названий в нижнем регистре и бинарный поиск.
+    """
+    model = Ingredients
+
+    def build(self, objects):
+        objects.sort(
+            key=lambda ingredient: (
+                ingredient.name.lower(), ingredient.measurement_unit)
+        )
+        return [ingredient.name.lower() for ingredient in objects], objects
+
+    def search(self, terms, limit=None):
+        """
+        Возвращает ингредиенты, названия которых начинаются
+        с каждого из переданных слов. Без слов - все ингредиенты.
+        """
+        limit = limit or settings.INGREDIENTS_AUTOCOMPLETE_LIMIT
+        names, ingredients = self.get_data()
+        if not terms:
+            return ingredients[:limit]
+        prefix = max(terms, key=len)
+        result = []
+        for position in range(bisect_left(names, prefix), len(names)):
+            name = names[position]
+            if not name.startswith(prefix):
+                break
+            if all(name.startswith(term) for term in terms):
+                result.append(ingredients[position])
+                if len(result) == limit:
+                    break
+        return result
+
+
+class TagRegistry(ModelSnapshot):
+    """
+    Все тэги в памяти процесса: по id, по slug и списком
+    в порядке сортировки модели.
+    """
+    model = Tag
+
+    def build(self, objects):
+        objects.sort(key=lambda tag: tag.name, reverse=True)
+        return (
+            objects,
+            {tag.pk: tag for tag in objects},
+            {tag.slug: tag for tag in objects},
+        )
+
+    def all(self):
+        return self.get_data()[0]
+
+    def get_by_pk(self, pk):
+        return self.get_data()[1].get(pk)
+
+    def get_by_slug(self, slug):
+        return self.get_data()[2].get(slug)
+
+    def choices(self):
+        return [(tag.slug, tag.name) for tag in self.all()]
+
+
+ingredients_index = IngredientsIndex()
+tag_registry = TagRegistry()
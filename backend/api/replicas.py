@@ -0,0 +1,108 @@
+import hashlib
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .registries import is_shared_cache
+
+REPLICA = {
+    'ALIASES': [],
+    'PIN_SECONDS': 5,
+    'VIEWS': (),
+}
+
+# Таблицы, которые читаются только с основной базы: сразу после входа
+# токена или сессии на реплике может ещё не быть.
+PRIMARY_MODELS = {'authtoken.token', 'sessions.session'}
+
+state = threading.local()
+
+
+def get_replica_settings():
+    return {**REPLICA, **getattr(settings, 'REPLICA', {})}
+
+
+def use_replica(alias):
+    """Чтения текущего потока до записи идут в реплику alias."""
+    state.replica = alias
+    state.wrote = False
+
+
+def get_replica():
+    return getattr(state, 'replica', None)
+
+
+def reset():
+    """Возвращает флаг записи и сбрасывает состояние потока."""
+    wrote = getattr(state, 'wrote', False)
+    state.replica = None
+    state.wrote = False
+    return wrote
+
+
+def choose_replica():
+    """
+    Случайная реплика или None. Привязка к основной базе хранится
+    в кеше, поэтому без общего для воркеров кеша реплики не используются:
+    запись в одном воркере не привязала бы клиента в остальных.
+    """
+    aliases = get_replica_settings()['ALIASES']
+    if not aliases or not is_shared_cache():
+        return None
+    return random.choice(aliases)
+
+
+def get_pin_key(request):
+    """
+    Ключ кеша для привязки клиента к основной базе: по заголовку
+    авторизации или cookie сессии, без запросов к базе.
+    """
+    credentials = (
+        request.META.get('HTTP_AUTHORIZATION')
+        or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    )
+    if not credentials:
+        return None
+    digest = hashlib.sha256(credentials.encode()).hexdigest()
+    return f'replica-pin:{digest}'
+
+
+def is_pinned(key):
+    return key is not None and cache.get(key) is not None
+
+
+def pin(key):
+    """
+    Читать с основной базы PIN_SECONDS секунд после записи клиента,
+    чтобы он видел свои изменения, пока реплика отстаёт.
+    """
+    if key is not None:
+        cache.set(key, 1, get_replica_settings()['PIN_SECONDS'])
+
+
+class ReplicaRouter:
+    """
+    Чтения обработчиков, выбранных ReplicaMiddleware, идут в реплику,
+    остальные запросы и всё после первой записи - в основную базу.
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = get_replica()
+        if (
+            replica is None
+            or getattr(state, 'wrote', False)
+            or model._meta.label_lower in PRIMARY_MODELS
+        ):
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и основная база.
+        return True
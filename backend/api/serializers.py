@@ -1,11 +1,15 @@
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from djoser.serializers import UserCreateSerializer
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 
+from .registries import tag_registry
+from .utils import get_subscribed_ids
 from recipes.models import (
     Cart, Favorite, Ingredients, IngredientsAmount, Recipe, Tag,
 )
+from recipes.services import change_recipe_totals
 from users.models import Subscribe
 
 User = get_user_model()
@@ -28,12 +32,7 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
     def get_is_subscribed(self, obj):
-        user = self.context['request'].user
-
-        return (
-            not user.is_anonymous
-            and user.subscriber.filter(author=obj).exists()
-        )
+        return obj.pk in get_subscribed_ids(self.context['request'])
 
 
 class UserCreateSerializer(UserCreateSerializer):
@@ -104,21 +103,7 @@ class SubscribeSerializer(UserSerializer):
         )
 
     def get_recipes(self, obj):
-        recipes_limit = self.context.get(
-            'request').query_params.get('recipes_limit')
-        if recipes_limit:
-            if not recipes_limit.isdigit():
-                message = 'Параметр recipes_limit должен быть числом'
-                raise serializers.ValidationError(message)
-            recipes_limit = int(recipes_limit)
-            if recipes_limit < 0:
-                message = 'Параметр recipes_limit должен быть больше 0'
-                raise serializers.ValidationError(message)
-
-        serializer = SimpleRecipeSerializer(
-            obj.recipe.all()[:recipes_limit],
-            many=True,
-        )
+        serializer = SimpleRecipeSerializer(obj.limited_recipes, many=True)
 
         return serializer.data
 
@@ -172,21 +157,30 @@ class RecipeSerializer(serializers.ModelSerializer):
 
 
 class IngredientsAmountSerializer(serializers.ModelSerializer):
-    id = serializers.SlugRelatedField(
-        slug_field='id',
-        queryset=Ingredients.objects.all()
-    )
+    id = serializers.IntegerField()
 
     class Meta:
         fields = ('id', 'amount')
         model = IngredientsAmount
 
 
+class TagPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Берёт тэги из реестра в памяти вместо запроса к базе."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool) or not str(data).isdigit():
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        tag = tag_registry.get_by_pk(int(data))
+        if tag is None:
+            self.fail('does_not_exist', pk_value=data)
+        return tag
+
+
 class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
     ingredients = IngredientsAmountSerializer(
         many=True,
     )
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = TagPrimaryKeyRelatedField(
         many=True,
         queryset=Tag.objects.all()
     )
@@ -204,6 +198,23 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ('author',)
 
+    def validate_ingredients(self, ingredients):
+        """
+        Получает все ингредиенты рецепта одним запросом
+        и сообщает сразу обо всех несуществующих id.
+        """
+        ingredients_ids = [ingredient['id'] for ingredient in ingredients]
+        found = Ingredients.objects.in_bulk(ingredients_ids)
+        missing = sorted(set(ingredients_ids) - found.keys())
+        if missing:
+            raise serializers.ValidationError(
+                'Таких ингредиентов не существует: '
+                f'{", ".join(map(str, missing))}.'
+            )
+        for ingredient in ingredients:
+            ingredient['id'] = found[ingredient['id']]
+        return ingredients
+
     def validate(self, data):
         ingredients = data.get('ingredients')
         tags = data.get('tags')
@@ -224,11 +235,6 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         if len(tags) == 0:
             raise serializers.ValidationError('Укажите теги рецепта')
 
-        for tag in tags:
-            if tag not in Tag.objects.all():
-                raise serializers.ValidationError(
-                    'Такого тега не существует!'
-                )
         if cooking_time <= 0:
             raise serializers.ValidationError(
                 'Время приготовления не может быть 0 или меньше.'
@@ -236,30 +242,63 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         return data
 
     def add_ingredients(self, instance, ingrs_data):
-        for ingredients in ingrs_data:
-            ingridient, amount = ingredients.values()
-            through = IngredientsAmount(
+        IngredientsAmount.objects.bulk_create(
+            IngredientsAmount(
                 recipe=instance,
-                ingredients=ingridient,
-                amount=amount,
+                ingredients=ingredient['id'],
+                amount=ingredient['amount'],
             )
-            through.save()
+            for ingredient in ingrs_data
+        )
+        return instance
+
+    def update_ingredients(self, instance, ingrs_data):
+        """
+        Приводит ингредиенты рецепта к переданным: добавляет новые,
+        меняет изменившиеся количества и удаляет лишние.
+        """
+        current = {
+            amount.ingredients_id: amount
+            for amount in instance.ingredientsamount_set.all()
+        }
+        old_amounts = {
+            ingredient_id: amount.amount
+            for ingredient_id, amount in current.items()
+        }
+        new_amounts = {
+            ingredient['id'].pk: ingredient['amount']
+            for ingredient in ingrs_data
+        }
+        changed = []
+        for ingredient_id, amount in new_amounts.items():
+            through = current.get(ingredient_id)
+            if through is not None and through.amount != amount:
+                through.amount = amount
+                changed.append(through)
+        instance.ingredientsamount_set.exclude(
+            ingredients_id__in=new_amounts).delete()
+        IngredientsAmount.objects.bulk_update(changed, ('amount',))
+        self.add_ingredients(
+            instance,
+            (
+                ingredient for ingredient in ingrs_data
+                if ingredient['id'].pk not in current
+            ),
+        )
+        change_recipe_totals(instance, old_amounts, new_amounts)
         return instance
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients_data = validated_data.pop('ingredients')
         instance = super().create(validated_data)
         return self.add_ingredients(instance, ingredients_data)
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         ingredients_data = validated_data.pop('ingredients')
         super().update(instance, validated_data)
-        instance.ingredients.clear()
-        self.add_ingredients(
-            instance, ingredients_data
-        )
-        instance.save()
-        return instance
+        return self.update_ingredients(instance, ingredients_data)
 
 
 class FavoriteAndCartSerializerMixin(serializers.ModelSerializer):
@@ -271,22 +310,6 @@ class FavoriteAndCartSerializerMixin(serializers.ModelSerializer):
         queryset=Recipe.objects.all(),
     )
 
-    def favorite_cart_validator(self, data, model):
-        request = self.context.get('request')
-        recipe = data.get('recipes')
-        instanse, _ = model.objects.get_or_create(
-            user=request.user)
-        favorite_exist = instanse.recipes.filter(pk=recipe.pk).exists()
-        if request.method == 'DELETE':
-            if not favorite_exist:
-                msg = 'Вы не добавляли этот рецепт'
-                raise serializers.ValidationError(msg)
-        if request.method == 'POST':
-            if favorite_exist:
-                msg = 'Этот рецепт уже добавлен'
-                raise serializers.ValidationError(msg)
-        return data
-
     def to_representation(self, instance):
         serializer = SimpleRecipeSerializer(
             instance.get('recipes'),
@@ -301,9 +324,6 @@ class FavoriteSerializer(FavoriteAndCartSerializerMixin):
         fields = '__all__'
         model = Favorite
 
-    def validate(self, data):
-        return self.favorite_cart_validator(data, Favorite)
-
 
 class CartSerializer(FavoriteAndCartSerializerMixin):
 
@@ -311,5 +331,13 @@ class CartSerializer(FavoriteAndCartSerializerMixin):
         model = Cart
         fields = '__all__'
 
-    def validate(self, data):
-        return self.favorite_cart_validator(data, Cart)
+
+class RecipeIdsSerializer(serializers.Serializer):
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=100,
+    )
+
+    def validate_recipes(self, value):
+        return list(dict.fromkeys(value))
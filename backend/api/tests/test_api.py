@@ -1,18 +1,50 @@
 import inspect
+import io
 import json
+import os
 import shutil
+import sys
 import tempfile
+import time
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections
+from django.db.models import Exists, OuterRef
 from django.test import TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
 from . import fixtures as fixt
-from recipes.models import Recipe
+from api.bitmaps import iter_positions, recipe_index, to_bitmap
+from api.checks import check_shared_cache
+from api.metrics import DB_QUERIES, RESPONSE_BYTES, WRITES
+from api.middleware import QueryCollector
+from api.profiling import (
+    StackSampler, get_profiles_dir, list_profiles, read_profile,
+)
+from api.registries import tag_registry
+from api.replicas import ReplicaRouter
+from recipes.models import (
+    Cart, CartIngredientsTotal, Favorite, IngredientsAmount, Recipe, Tag,
+)
+from recipes.services import add_to_collection, collection_changed
+from users.models import Subscribe
 
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+# Общий для процессов кеш, без которого не включаются индекс и реплики.
+SHARED_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(TEMP_MEDIA_ROOT, 'cache'),
+    }
+}
 
 User = get_user_model()
 
@@ -503,3 +535,1133 @@ class GetAllUsersTest(TestCase):
             subscribed_authors_count - 1,
             msg=msg,
         )
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class QueryCountTest(TestCase):
+    """ Количество SQL запросов не зависит от размера страницы """
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        self.author = fixt.create_user(**fixt.SECOND_USER)
+        fixt.create_subscribe(self.user, self.author)
+        self.tag = fixt.create_tag()
+        self.ingredient = fixt.create_ingredient()
+
+        self.auth_client = APIClient()
+        self.auth_client.force_authenticate(user=self.user)
+
+    def add_recipes(self, count):
+        for _ in range(count):
+            recipe = fixt.create_recipe(
+                self.author,
+                self.tag,
+                self.ingredient,
+                name=get_random_string(12),
+            )
+            IngredientsAmount.objects.create(
+                recipe=recipe,
+                ingredients=self.ingredient,
+                amount=1,
+            )
+
+    def count_queries(self, client, url):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context)
+
+    @tag('performance')
+    def test_recipe_list_query_count(self):
+        """Список рецептов загружается фиксированным числом запросов"""
+        url = '/api/recipes/?limit=100'
+        for test_client in (client, self.auth_client):
+            with self.subTest(authenticated=test_client is not client):
+                self.add_recipes(2)
+                expected = self.count_queries(test_client, url)
+                self.add_recipes(10)
+                msg = f'{url} Количество запросов зависит от числа рецептов.'
+                self.assertEqual(
+                    self.count_queries(test_client, url), expected, msg)
+
+    @tag('performance')
+    def test_user_list_query_count(self):
+        """Список пользователей загружается фиксированным числом запросов"""
+        url = '/api/users/?limit=50'
+        expected = self.count_queries(self.auth_client, url)
+        for number in range(10):
+            author = fixt.create_user(
+                username=f'author_{number}',
+                email=f'author_{number}@test.ru',
+                first_name='author',
+                last_name='author',
+                password='author',
+            )
+            fixt.create_subscribe(self.user, author)
+        msg = f'{url} Количество запросов зависит от числа пользователей.'
+        self.assertEqual(
+            self.count_queries(self.auth_client, url), expected, msg)
+
+    @tag('performance')
+    def test_subscriptions_query_count(self):
+        """Подписки загружаются фиксированным числом запросов"""
+        url = '/api/users/subscriptions/?limit=10&recipes_limit=2'
+        self.add_recipes(3)
+        expected = self.count_queries(self.auth_client, url)
+        for number in range(5):
+            author = fixt.create_user(
+                username=f'author_{number}',
+                email=f'author_{number}@test.ru',
+                first_name='author',
+                last_name='author',
+                password='author',
+            )
+            fixt.create_subscribe(self.user, author)
+            fixt.create_recipe(
+                author, self.tag, self.ingredient, name=f'recipe_{number}')
+        msg = f'{url} Количество запросов зависит от числа подписок.'
+        self.assertEqual(
+            self.count_queries(self.auth_client, url), expected, msg)
+
+        response = self.auth_client.get(url)
+        for author in response.data['results']:
+            with self.subTest(author=author['username']):
+                self.assertLessEqual(len(author['recipes']), 2)
+                self.assertEqual(
+                    len(author['recipes']), min(author['recipes_count'], 2))
+
+        response = self.auth_client.get(url.replace('2', 'two'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @tag('performance')
+    def test_recipe_update_write_statements(self):
+        """Обновление ингредиентов рецепта не пишет построчно"""
+        ingredients = [
+            fixt.create_ingredient(f'ingredient_{number}')
+            for number in range(30)
+        ]
+        recipe = fixt.create_recipe(self.author, self.tag, self.ingredient)
+        IngredientsAmount.objects.bulk_create(
+            IngredientsAmount(recipe=recipe, ingredients=ingredient, amount=1)
+            for ingredient in ingredients[:20]
+        )
+        author_client = APIClient()
+        author_client.force_authenticate(user=self.author)
+        data = {
+            'ingredients': [
+                {'id': ingredient.pk, 'amount': number % 3 + 1}
+                for number, ingredient in enumerate(ingredients[10:])
+            ],
+            'tags': [self.tag.pk],
+            'cooking_time': 5,
+        }
+        with CaptureQueriesContext(connection) as context:
+            response = author_client.patch(
+                f'/api/recipes/{recipe.pk}/',
+                data=json.dumps(data),
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        writes = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+        ]
+        self.assertLessEqual(len(writes), 8, msg='\n'.join(writes))
+        self.assertEqual(
+            dict(recipe.ingredientsamount_set.values_list(
+                'ingredients_id', 'amount')),
+            {
+                ingredient['id']: ingredient['amount']
+                for ingredient in data['ingredients']
+            },
+        )
+
+    @tag('performance')
+    def test_recipe_ingredients_validation_queries(self):
+        """Ингредиенты рецепта проверяются одним запросом"""
+        ingredients = [
+            fixt.create_ingredient(f'ingredient_{number}')
+            for number in range(25)
+        ]
+        recipe = fixt.create_recipe(self.author, self.tag, self.ingredient)
+        author_client = APIClient()
+        author_client.force_authenticate(user=self.author)
+        url = f'/api/recipes/{recipe.pk}/'
+        author_client.get('/api/tags/')
+        queries = []
+        for count in (5, 25):
+            data = {
+                'ingredients': [
+                    {'id': ingredient.pk, 'amount': 1}
+                    for ingredient in ingredients[:count]
+                ],
+                'tags': [self.tag.pk],
+                'cooking_time': 5,
+            }
+            with CaptureQueriesContext(connection) as context:
+                response = author_client.patch(
+                    url,
+                    data=json.dumps(data),
+                    content_type='application/json',
+                )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+
+        data['ingredients'] += [
+            {'id': 998, 'amount': 1}, {'id': 999, 'amount': 1}]
+        response = author_client.patch(
+            url,
+            data=json.dumps(data),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('998, 999', str(response.data['ingredients']))
+
+    @tag('performance')
+    def test_favorite_toggle_queries(self):
+        """Добавление в избранное и удаление - одна запись в таблицу связей"""
+        recipe = fixt.create_recipe(self.author, self.tag, self.ingredient)
+        url = f'/api/recipes/{recipe.pk}/favorite/'
+        self.auth_client.post(url)
+        self.auth_client.delete(url)
+        for method, expected in (
+            (self.auth_client.post, status.HTTP_201_CREATED),
+            (self.auth_client.post, status.HTTP_400_BAD_REQUEST),
+            (self.auth_client.delete, status.HTTP_204_NO_CONTENT),
+            (self.auth_client.delete, status.HTTP_400_BAD_REQUEST),
+        ):
+            with CaptureQueriesContext(connection) as context:
+                response = method(url)
+            self.assertEqual(response.status_code, expected)
+            statements = [
+                query['sql'] for query in context.captured_queries
+                if 'SAVEPOINT' not in query['sql']
+            ]
+            self.assertLessEqual(
+                len(statements), 3, msg='\n'.join(statements))
+
+    @tag('performance')
+    def test_cart_toggle_updates_totals(self):
+        """Суммы корзины обновляются без сигналов m2m"""
+        recipe = fixt.create_recipe(self.author, self.tag, self.ingredient)
+        IngredientsAmount.objects.create(
+            recipe=recipe, ingredients=self.ingredient, amount=3)
+        url = f'/api/recipes/{recipe.pk}/shopping_cart/'
+        self.auth_client.post(url)
+        self.assertEqual(
+            list(self.user.cart_totals.values_list('amount', flat=True)),
+            [3],
+        )
+        self.auth_client.delete(url)
+        self.assertFalse(self.user.cart_totals.exists())
+
+    @tag('performance')
+    def test_cart_totals_error_not_reported_as_duplicate(self):
+        """Ошибка сумм корзины не выдаётся за повторное добавление"""
+        recipe = fixt.create_recipe(self.author, self.tag, self.ingredient)
+        with mock.patch(
+            'recipes.services.change_cart_totals',
+            side_effect=IntegrityError,
+        ):
+            with self.assertRaises(IntegrityError):
+                add_to_collection(Cart, self.user, recipe.pk)
+        self.assertFalse(Cart.recipes.through.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CursorPaginationTest(TestCase):
+    """ Курсорная пагинация """
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        tag = fixt.create_tag()
+        ingredient = fixt.create_ingredient()
+        for number in range(5):
+            fixt.create_recipe(
+                self.user, tag, ingredient, name=f'recipe_{number}')
+
+    @tag('api')
+    def test_page_number_is_default(self):
+        """По умолчанию пагинация постраничная"""
+        response = client.get('/api/recipes/?limit=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 5)
+
+    @tag('api')
+    def test_recipes_cursor_walk(self):
+        """Курсорная пагинация проходит все рецепты без COUNT"""
+        url = '/api/recipes/?pagination=cursor&limit=2'
+        names = []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            for query in context.captured_queries:
+                self.assertNotIn('COUNT(', query['sql'])
+            self.assertLessEqual(len(response.data['results']), 2)
+            names += [recipe['name'] for recipe in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(
+            names,
+            list(Recipe.objects.values_list('name', flat=True)),
+        )
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class ShoppingCartDownloadTest(TestCase):
+    """ Скачивание списка покупок """
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        tag = fixt.create_tag()
+        sugar = fixt.create_ingredient('сахар', 'г')
+        salt = fixt.create_ingredient('соль', 'г')
+        first = fixt.create_recipe(self.user, tag, sugar, name='first')
+        second = fixt.create_recipe(self.user, tag, sugar, name='second')
+        IngredientsAmount.objects.bulk_create((
+            IngredientsAmount(recipe=first, ingredients=sugar, amount=10),
+            IngredientsAmount(recipe=first, ingredients=salt, amount=1),
+            IngredientsAmount(recipe=second, ingredients=sugar, amount=5),
+        ))
+        cart = fixt.create_cart(self.user, first)
+        cart.recipes.add(second)
+
+        self.auth_client = APIClient()
+        self.auth_client.force_authenticate(user=self.user)
+
+    @tag('api')
+    def test_download_shopping_cart(self):
+        """Ингредиенты суммируются одним запросом"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.auth_client.get(
+                '/api/recipes/download_shopping_cart/')
+            content = b''.join(response.streaming_content).decode()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(content, 'сахар (г) - 15\nсоль (г) - 1')
+        self.assertEqual(len(context), 1)
+
+
+class IngredientsSearchTest(TestCase):
+    """ Автодополнение ингредиентов """
+    def setUp(self):
+        for name in ('сахар', 'сахарная пудра', 'соль', 'Сахарин'):
+            fixt.create_ingredient(name, 'г')
+
+    @tag('api')
+    def test_ingredients_search(self):
+        """Поиск по началу названия без запросов к базе"""
+        with CaptureQueriesContext(connection) as context:
+            client.get('/api/ingredients/?name=')
+            response = client.get('/api/ingredients/?name=САХАР')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [ingredient['name'] for ingredient in response.data],
+            ['сахар', 'Сахарин', 'сахарная пудра'],
+        )
+        self.assertEqual(len(context), 1)
+
+    @tag('api')
+    @override_settings(INGREDIENTS_AUTOCOMPLETE_LIMIT=1)
+    def test_ingredients_search_limit(self):
+        """Размер выдачи ограничен"""
+        response = client.get('/api/ingredients/?name=с')
+        self.assertEqual(len(response.data), 1)
+
+    @tag('api')
+    def test_ingredients_index_refresh(self):
+        """Индекс обновляется при изменении ингредиентов"""
+        client.get('/api/ingredients/?name=с')
+        fixt.create_ingredient('сода', 'г')
+        response = client.get('/api/ingredients/?name=сод')
+        self.assertEqual(
+            [ingredient['name'] for ingredient in response.data], ['сода'])
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class TagRegistryTest(TestCase):
+    """ Тэги из реестра в памяти """
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.tag = fixt.create_tag()
+        fixt.create_tag('Обед', '#000000', 'lunch')
+
+    @tag('api')
+    def test_tags_without_queries(self):
+        """Тэги отдаются без запросов к базе"""
+        client.get('/api/tags/')
+        with self.assertNumQueries(0):
+            response = client.get('/api/tags/')
+            self.assertEqual(
+                [tag['slug'] for tag in response.data],
+                ['lunch', 'test_slug'],
+            )
+            response = client.get(f'/api/tags/{self.tag.pk}/')
+            self.assertEqual(response.data['slug'], 'test_slug')
+            response = client.get('/api/tags/999/')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @tag('api')
+    def test_tags_registry_ttl(self):
+        """С кешем в памяти процесса снимок устаревает по времени"""
+        client.get('/api/tags/')
+        # Изменение в другом процессе: версия в чужом кеше.
+        Tag.objects.filter(pk=self.tag.pk).update(name='Ужин')
+        response = client.get(f'/api/tags/{self.tag.pk}/')
+        self.assertEqual(response.data['name'], 'Test_tag')
+        with override_settings(SNAPSHOT_TTL=0):
+            response = client.get(f'/api/tags/{self.tag.pk}/')
+        self.assertEqual(response.data['name'], 'Ужин')
+
+    @tag('api')
+    @override_settings(CACHES=SHARED_CACHES, SNAPSHOT_CHECK_INTERVAL=60)
+    def test_tags_registry_version_checks(self):
+        """Версия реестра читается из кеша не на каждый тэг"""
+        url = '/api/recipes/?tags=lunch&tags=test_slug'
+        client.get(url)
+        with mock.patch('api.registries.cache', wraps=cache) as shared:
+            response = client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        shared.get.assert_not_called()
+        # Изменение в другом процессе видно после интервала проверки.
+        Tag.objects.filter(pk=self.tag.pk).update(name='Ужин')
+        version = cache.get(tag_registry.version_key, 0)
+        cache.set(tag_registry.version_key, version + 1, None)
+        response = client.get(f'/api/tags/{self.tag.pk}/')
+        self.assertEqual(response.data['name'], 'Test_tag')
+        with override_settings(SNAPSHOT_CHECK_INTERVAL=0):
+            response = client.get(f'/api/tags/{self.tag.pk}/')
+        self.assertEqual(response.data['name'], 'Ужин')
+
+    @tag('api')
+    def test_tags_registry_refresh(self):
+        """Реестр обновляется при изменении тэгов"""
+        client.get('/api/tags/')
+        self.tag.name = 'Завтрак'
+        self.tag.save()
+        response = client.get(f'/api/tags/{self.tag.pk}/')
+        self.assertEqual(response.data['name'], 'Завтрак')
+
+    @tag('api')
+    def test_recipes_tags_filter(self):
+        """Фильтр рецептов по тэгам"""
+        response = client.get('/api/recipes/?tags=lunch&tags=test_slug')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = client.get('/api/recipes/?tags=unknown')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @tag('api')
+    def test_recipes_tags_modes(self):
+        """Рецепты с несколькими тэгами не дублируются"""
+        lunch = Tag.objects.get(slug='lunch')
+        ingredient = fixt.create_ingredient()
+        both = fixt.create_recipe(
+            fixt.create_user(**fixt.FIRST_USER), self.tag, ingredient,
+            name='both')
+        both.tags.add(lunch)
+        fixt.create_recipe(both.author, self.tag, ingredient, name='one')
+
+        url = '/api/recipes/?tags=lunch&tags=test_slug'
+        response = client.get(url)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(
+            sorted(recipe['name'] for recipe in response.data['results']),
+            ['both', 'one'],
+        )
+        response = client.get(f'{url}&tags_mode=all')
+        self.assertEqual(
+            [recipe['name'] for recipe in response.data['results']],
+            ['both'],
+        )
+        response = client.get(f'{url}&tags_mode=unknown')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class QueryBudgetMiddlewareTest(TestCase):
+    """ Учёт SQL запросов по обработчикам """
+    def setUp(self):
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+
+    @tag('performance')
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        """В режиме DEBUG запросы обработчика видны в заголовках"""
+        response = client.get('/api/users/')
+        self.assertEqual(response['X-View'], 'UserViewSet.list')
+        self.assertEqual(int(response['X-Query-Count']), 2)
+        self.assertIn('X-Query-Time', response)
+        response = client.get('/api/recipes/download_shopping_cart/')
+        self.assertEqual(response['X-View'], 'download_shopping_cart')
+
+    @tag('performance')
+    def test_no_headers_without_debug(self):
+        response = client.get('/api/users/')
+        self.assertNotIn('X-Query-Count', response)
+
+    @tag('performance')
+    @override_settings(QUERY_BUDGET={'VIEWS': {'UserViewSet.list': 1}})
+    def test_budget_exceeded(self):
+        """Превышение бюджета обработчика попадает в лог"""
+        with self.assertLogs('api.queries', 'WARNING') as logs:
+            client.get('/api/users/')
+        self.assertIn('UserViewSet.list', logs.output[0])
+        self.assertIn('бюджет 1', logs.output[0])
+
+    @tag('performance')
+    @override_settings(
+        QUERY_BUDGET={'VIEWS': {'download_shopping_cart': 0}})
+    def test_streaming_queries_counted(self):
+        """Запросы потокового ответа считаются до конца его чтения"""
+        auth_client = APIClient()
+        auth_client.force_authenticate(user=self.user)
+        response = auth_client.get('/api/recipes/download_shopping_cart/')
+        with self.assertLogs('api.queries', 'WARNING') as logs:
+            b''.join(response.streaming_content)
+        self.assertIn('download_shopping_cart', logs.output[0])
+        self.assertIn('1 SQL запросов', logs.output[0])
+
+    @tag('performance')
+    def test_repeated_queries(self):
+        """Повторяющийся запрос определяется вместе с местом вызова"""
+        collector = QueryCollector(repeated=3)
+        with connection.execute_wrapper(collector):
+            for pk in range(5):
+                User.objects.filter(pk=pk).exists()
+        self.assertEqual(collector.count, 5)
+        [(sql, count, call_site)] = collector.get_repeated()
+        self.assertEqual(count, 5)
+        self.assertIn('users_user', sql)
+        self.assertIn('test_api.py', call_site)
+        self.assertIn('test_repeated_queries', call_site)
+
+
+class ProfilingTest(TestCase):
+    """ Профилирование запросов """
+    def setUp(self):
+        profiles_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profiles_dir.cleanup)
+        settings = override_settings(PROFILING={
+            'DIR': profiles_dir.name, 'INTERVAL': 0.0001})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        self.staff = fixt.create_user(**fixt.SECOND_USER)
+        self.staff.is_staff = True
+        self.staff.save()
+
+    def profile(self, user):
+        profile_client = APIClient()
+        profile_client.credentials(
+            HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user)}')
+        with mock.patch.object(StackSampler, 'save') as save:
+            profile_client.get('/api/users/', HTTP_X_PROFILE='1')
+        return save
+
+    @tag('performance')
+    def test_sampler(self):
+        """Стеки снимаются с потока запроса"""
+        def work():
+            time.sleep(0.05)
+
+        sampler = StackSampler(0.001)
+        sampler.start(sys._getframe())
+        work()
+        sampler.stop()
+        self.assertTrue(sampler.stacks)
+        self.assertEqual(set(sampler.stacks), {'api.tests.test_api:work'})
+
+    @tag('performance')
+    def test_profile_by_header(self):
+        """По заголовку профилируются только запросы staff"""
+        with mock.patch.object(StackSampler, 'start') as start:
+            self.profile(self.user).assert_not_called()
+            client.get('/api/users/', HTTP_X_PROFILE='1')
+            start.assert_not_called()
+        self.profile(self.staff).assert_called_once_with('UserViewSet.list')
+
+    @tag('performance')
+    def test_profile_size_limit(self):
+        """Файл профиля больше лимита начинается заново"""
+        sampler = StackSampler(0.001)
+        sampler.stacks.update({'a;b': 1})
+        with override_settings(PROFILING={
+            'DIR': get_profiles_dir(), 'MAX_BYTES': 10,
+        }):
+            for _ in range(3):
+                sampler.save('UserViewSet.list')
+        self.assertEqual(read_profile('UserViewSet.list.folded'), 'a;b 1\n')
+        self.assertEqual(
+            [name for name, _ in list_profiles()],
+            ['UserViewSet.list.folded'],
+        )
+
+    @tag('performance')
+    def test_profiles_admin(self):
+        """Профили скачиваются staff пользователями из админки"""
+        sampler = StackSampler(0.001)
+        sampler.stacks.update({'a;b': 2, 'a;c': 1})
+        sampler.save('UserViewSet.list')
+        sampler.save('UserViewSet.list')
+        [(name, _)] = list_profiles()
+        self.assertEqual(name, 'UserViewSet.list.folded')
+
+        self.client.force_login(self.user)
+        response = self.client.get('/admin/profiles/')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.client.force_login(self.staff)
+        response = self.client.get('/admin/profiles/')
+        self.assertContains(response, name)
+        response = self.client.get(f'/admin/profiles/{name}/')
+        self.assertEqual(response.content, b'a;b 4\na;c 2\n')
+        response = self.client.get('/admin/profiles/unknown.folded/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class MetricsTest(TestCase):
+    """ Метрики Prometheus """
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        self.tag = fixt.create_tag()
+
+    def get_metrics(self):
+        response = client.get('/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.content.decode()
+
+    @tag('api')
+    def test_request_metrics(self):
+        """Запросы учитываются по обработчику и статусу"""
+        client.get('/api/tags/')
+        client.get('/api/tags/')
+        client.get(f'/api/tags/{self.tag.pk}/')
+        content = self.get_metrics()
+        self.assertIn(
+            'foodgram_http_request_duration_seconds_count{'
+            'route="TagViewSet.list",method="GET",status="200"}',
+            content,
+        )
+        self.assertIn(
+            'foodgram_serializer_duration_seconds_count'
+            '{serializer="TagSerializer"}',
+            content,
+        )
+        self.assertIn('foodgram_db_queries_bucket{route="TagViewSet.list"',
+                      content)
+        self.assertIn(
+            'foodgram_cache_requests_total{cache="tag",result="hit"}',
+            content,
+        )
+
+    @tag('api')
+    def test_streaming_metrics(self):
+        """Запросы и размер потокового ответа учитываются после чтения"""
+        auth_client = APIClient()
+        auth_client.force_authenticate(user=self.user)
+        key = ('download_shopping_cart',)
+        queries = list(DB_QUERIES.values.get(key, [0, 0]))
+        response = auth_client.get('/api/recipes/download_shopping_cart/')
+        self.assertEqual(list(DB_QUERIES.values.get(key, [0, 0])), queries)
+        b''.join(response.streaming_content)
+        # Одно наблюдение: один запрос за корзиной.
+        self.assertEqual(DB_QUERIES.values[key][-1], queries[-1] + 1)
+        self.assertIn(key, RESPONSE_BYTES.values)
+
+    @tag('api')
+    def test_writes_metrics(self):
+        """Считаются изменения избранного"""
+        recipe = fixt.create_recipe(
+            self.user, self.tag, fixt.create_ingredient())
+        auth_client = APIClient()
+        auth_client.force_authenticate(user=self.user)
+        before = WRITES.values.get(('favorite', 'add'), 0)
+        auth_client.post(f'/api/recipes/{recipe.pk}/favorite/')
+        self.assertEqual(WRITES.values[('favorite', 'add')], before + 1)
+
+    @tag('api')
+    @override_settings(METRICS_ALLOWED_IPS=[])
+    def test_metrics_access(self):
+        """Метрики закрыты от посторонних"""
+        response = client.get('/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @tag('api')
+    def test_workers_aggregation(self):
+        """Значения воркеров из общего каталога суммируются"""
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        worker = {'foodgram_writes_total': [[['cart', 'add'], 5]]}
+        with open(f'{metrics_dir.name}/1.json', 'w') as file:
+            json.dump(worker, file)
+        with open(f'{metrics_dir.name}/2.json', 'w') as file:
+            json.dump(worker, file)
+        with override_settings(METRICS_DIR=metrics_dir.name):
+            own = WRITES.values.get(('cart', 'add'), 0)
+            content = self.get_metrics()
+        self.assertIn(
+            'foodgram_writes_total{model="cart",action="add"} '
+            f'{own + 10}',
+            content,
+        )
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class BulkFavoriteCartTest(TestCase):
+    """ Пакетное добавление в избранное и корзину """
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        tag = fixt.create_tag()
+        self.ingredient = fixt.create_ingredient()
+        self.recipes = [
+            fixt.create_recipe(
+                self.user, tag, self.ingredient, name=f'recipe_{number}')
+            for number in range(3)
+        ]
+        for recipe in self.recipes:
+            IngredientsAmount.objects.create(
+                recipe=recipe, ingredients=self.ingredient, amount=2)
+        self.auth_client = APIClient()
+        self.auth_client.force_authenticate(user=self.user)
+
+    def send(self, method, url, ids):
+        return getattr(self.auth_client, method)(
+            url, data={'recipes': ids}, format='json')
+
+    def get_results(self, response):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {
+            result['id']: result['result']
+            for result in response.data['results']
+        }
+
+    @tag('api')
+    def test_bulk_cart(self):
+        """Рецепты добавляются и убираются списком с итогом по каждому"""
+        first, second, third = (recipe.pk for recipe in self.recipes)
+        self.send('post', f'/api/recipes/{first}/shopping_cart/', None)
+        url = '/api/recipes/shopping_cart/'
+        results = self.get_results(
+            self.send('post', url, [first, second, third, 999, second]))
+        self.assertEqual(results, {
+            first: 'already_added',
+            second: 'added',
+            third: 'added',
+            999: 'not_found',
+        })
+        self.assertEqual(
+            self.user.cart_totals.get(ingredients=self.ingredient).amount, 6)
+
+        results = self.get_results(self.send('delete', url, [first, 999]))
+        self.assertEqual(results, {first: 'removed', 999: 'not_added'})
+        self.assertEqual(
+            self.user.cart_totals.get(ingredients=self.ingredient).amount, 4)
+
+        response = self.auth_client.delete('/api/recipes/shopping_cart/clear/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(self.user.cart_set.filter(recipes__isnull=False))
+        self.assertFalse(self.user.cart_totals.exists())
+
+    @tag('api')
+    def test_bulk_favorite(self):
+        url = '/api/recipes/favorite/'
+        ids = [recipe.pk for recipe in self.recipes]
+        results = self.get_results(self.send('post', url, ids))
+        self.assertEqual(set(results.values()), {'added'})
+        self.assertEqual(
+            self.user.favorite_set.get().recipes.count(), len(ids))
+
+    @tag('api')
+    def test_unchanged_collection_not_signalled(self):
+        """Запрос без изменений не сообщает об изменении коллекции"""
+        first = self.recipes[0].pk
+        self.send('post', '/api/recipes/favorite/', [first])
+        receiver = mock.Mock()
+        collection_changed.connect(receiver)
+        self.addCleanup(collection_changed.disconnect, receiver)
+        self.send('post', '/api/recipes/favorite/', [first, 999])
+        self.send('delete', '/api/recipes/shopping_cart/', [first])
+        self.auth_client.delete('/api/recipes/shopping_cart/clear/')
+        receiver.assert_not_called()
+
+    @tag('api')
+    def test_bulk_validation(self):
+        url = '/api/recipes/favorite/'
+        response = self.send('post', url, [])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.send('post', url, ['abc'])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = client.post(url, data={'recipes': [1]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class IndexUsageTest(TestCase):
+    """ Частые запросы API используют индексы """
+    @classmethod
+    def setUpTestData(cls):
+        media_root = tempfile.TemporaryDirectory()
+        with override_settings(MEDIA_ROOT=media_root.name):
+            call_command(
+                'generate_data',
+                '--users', '30',
+                '--recipes', '300',
+                '--ingredients', '30',
+                stdout=io.StringIO(),
+            )
+        media_root.cleanup()
+        cls.user = User.objects.get(username='load_user_1')
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan, msg=plan)
+
+    @tag('performance')
+    def test_recipe_list(self):
+        recipes = Recipe.objects.order_by('-publication_date', '-id')
+        self.assertUsesIndex(recipes[:10], 'recipe_publication_idx')
+        self.assertUsesIndex(
+            recipes.filter(author=self.user)[:10],
+            'recipe_author_publication_idx',
+        )
+        self.assertUsesIndex(
+            recipes.filter(tags__slug='load-tag-1')[:10],
+            'recipe_tags_tag_recipe_idx',
+        )
+
+    @tag('performance')
+    def test_subscribers(self):
+        self.assertUsesIndex(
+            Subscribe.objects.filter(author=self.user).values('user_id'),
+            'subscribe_author_user_idx',
+        )
+
+    @tag('performance')
+    def test_favorite_and_cart_membership(self):
+        recipe = Recipe.objects.first()
+        for model, index in (
+            (Favorite, 'favorite_recipes_recipe_idx'),
+            (Cart, 'cart_recipes_recipe_idx'),
+        ):
+            self.assertUsesIndex(
+                Recipe.objects.annotate(is_added=Exists(
+                    model.objects.filter(
+                        user=self.user, recipes=OuterRef('pk')),
+                ))[:10],
+                index,
+            )
+            self.assertUsesIndex(
+                model.recipes.through.objects.filter(recipe=recipe),
+                index,
+            )
+
+
+@override_settings(
+    MEDIA_ROOT=TEMP_MEDIA_ROOT,
+    RECIPE_BITMAP_INDEX=True,
+    CACHES=SHARED_CACHES,
+)
+class BitmapIndexTest(TestCase):
+    """ Фильтрация рецептов по битовому индексу """
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        self.author = fixt.create_user(**fixt.SECOND_USER)
+        self.tag = fixt.create_tag()
+        self.lunch = fixt.create_tag('Обед', '#000000', 'lunch')
+        self.ingredient = fixt.create_ingredient()
+        self.recipes = [
+            fixt.create_recipe(
+                author, self.tag, self.ingredient, name=f'recipe_{number}')
+            for number, author in enumerate(
+                (self.user, self.author, self.author, self.user))
+        ]
+        self.recipes[1].tags.add(self.lunch)
+        self.recipes[2].tags.set([self.lunch])
+        fixt.create_favorite(self.user, self.recipes[1])
+        fixt.create_cart(self.user, self.recipes[2])
+        recipe_index.invalidate()
+        self.auth_client = APIClient()
+        self.auth_client.force_authenticate(user=self.user)
+
+    def get_names(self, url, api_client=client):
+        response = api_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [recipe['name'] for recipe in response.data['results']]
+
+    @tag('performance')
+    def test_same_results_as_sql(self):
+        """Индекс отдаёт те же рецепты в том же порядке, что и SQL"""
+        urls = (
+            '/api/recipes/',
+            '/api/recipes/?tags=lunch',
+            '/api/recipes/?tags=lunch&tags=test_slug',
+            '/api/recipes/?tags=lunch&tags=test_slug&tags_mode=all',
+            f'/api/recipes/?author={self.author.pk}&tags=lunch',
+            '/api/recipes/?is_favorited=1',
+            '/api/recipes/?is_favorited=0&is_in_shopping_cart=0',
+            '/api/recipes/?is_in_shopping_cart=1&tags=lunch',
+            '/api/recipes/?limit=2&page=2',
+        )
+        for url in urls:
+            with self.subTest(url=url):
+                names = self.get_names(url, self.auth_client)
+                with override_settings(RECIPE_BITMAP_INDEX=False):
+                    self.assertEqual(
+                        self.get_names(url, self.auth_client), names)
+        response = self.auth_client.get('/api/recipes/?limit=2')
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(len(response.data['results']), 2)
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    })
+    def test_requires_shared_cache(self):
+        """Без общего кеша индекс не включается"""
+        self.assertFalse(recipe_index.is_enabled())
+        self.assertIn(
+            'api.E001', [error.id for error in check_shared_cache(None)])
+        names = self.get_names(
+            '/api/recipes/?is_favorited=1', self.auth_client)
+        self.assertEqual(names, ['recipe_1'])
+
+    def test_iter_positions(self):
+        """Страница битовой карты из нескольких кусков"""
+        positions = sorted(range(3, 20000, 7), reverse=True)
+        bitmap = to_bitmap(positions)
+        for start in (0, 1, 290, len(positions) - 1, len(positions)):
+            with self.subTest(start=start):
+                self.assertEqual(
+                    list(iter_positions(bitmap, start)), positions[start:])
+
+    @tag('performance')
+    def test_anonymous_collections(self):
+        """Для анонима избранное и корзина пусты"""
+        self.assertEqual(self.get_names('/api/recipes/?is_favorited=1'), [])
+        self.assertEqual(
+            len(self.get_names('/api/recipes/?is_in_shopping_cart=0')), 4)
+
+    @tag('performance')
+    def test_index_updates_on_commit(self):
+        """Изменения попадают в индекс после коммита"""
+        url = '/api/recipes/?is_favorited=1&tags=lunch'
+        self.assertEqual(
+            self.get_names(url, self.auth_client), ['recipe_1'])
+        second = self.recipes[2].pk
+        with self.captureOnCommitCallbacks(execute=True):
+            self.auth_client.post(f'/api/recipes/{second}/favorite/')
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe = fixt.create_recipe(
+                self.user, self.lunch, self.ingredient, name='new')
+        with self.captureOnCommitCallbacks(execute=True):
+            fixt.create_favorite(self.user, recipe)
+        # Индекс не перестраивается: реестр тэгов, подписки,
+        # рецепты страницы и две подгрузки для сериализатора.
+        with self.assertNumQueries(5):
+            self.assertEqual(
+                self.get_names(url, self.auth_client),
+                ['new', 'recipe_2', 'recipe_1'],
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.auth_client.delete(f'/api/recipes/{second}/favorite/')
+            self.recipes[1].tags.remove(self.lunch)
+        self.assertEqual(self.get_names(url, self.auth_client), ['new'])
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.delete()
+        self.assertEqual(self.get_names(url, self.auth_client), [])
+
+    @tag('performance')
+    def test_other_workers_replay_changes(self):
+        """Другие процессы применяют изменения из журнала без перестройки"""
+        url = '/api/recipes/?is_favorited=1&tags=lunch'
+        self.assertEqual(
+            self.get_names(url, self.auth_client), ['recipe_1'])
+        second = self.recipes[2].pk
+        # Изменения делает другой воркер: индекс этого процесса
+        # узнаёт о них только из журнала.
+        with mock.patch.object(recipe_index, 'ids', None):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.auth_client.post(f'/api/recipes/{second}/favorite/')
+                recipe = fixt.create_recipe(
+                    self.user, self.lunch, self.ingredient, name='new')
+                fixt.create_favorite(self.user, recipe)
+                self.recipes[1].tags.remove(self.lunch)
+        with mock.patch.object(recipe_index, 'build') as build:
+            self.assertEqual(
+                self.get_names(url, self.auth_client), ['new', 'recipe_2'])
+        build.assert_not_called()
+        with mock.patch.object(recipe_index, 'ids', None):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.recipes[2].tags.clear()
+        self.assertEqual(self.get_names(url, self.auth_client), ['new'])
+
+    @tag('performance')
+    def test_tag_facets(self):
+        """Счётчики тэгов при текущих фильтрах"""
+        cases = (
+            ('', 3, 2),
+            ('&tags=lunch', 3, 2),
+            ('&tags=lunch&tags_mode=all', 1, 2),
+            (f'&author={self.author.pk}', 1, 2),
+            ('&is_favorited=1', 1, 1),
+        )
+        for enabled in (True, False):
+            for params, test_slug, lunch in cases:
+                with self.subTest(params=params, enabled=enabled):
+                    with override_settings(RECIPE_BITMAP_INDEX=enabled):
+                        response = self.auth_client.get(
+                            f'/api/recipes/?facets=tags{params}')
+                    self.assertEqual(
+                        {
+                            facet['slug']: facet['count']
+                            for facet in response.data['facets']['tags']
+                        },
+                        {'test_slug': test_slug, 'lunch': lunch},
+                    )
+        response = self.auth_client.get('/api/recipes/')
+        self.assertNotIn('facets', response.data)
+
+    @tag('performance')
+    def test_cursor_and_invalid_params(self):
+        """Курсор и ошибки параметров обрабатываются как раньше"""
+        names = self.get_names('/api/recipes/?pagination=cursor&tags=lunch')
+        self.assertEqual(names, ['recipe_2', 'recipe_1'])
+        response = client.get('/api/recipes/?tags=unknown')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(
+    MEDIA_ROOT=TEMP_MEDIA_ROOT,
+    CACHES=SHARED_CACHES,
+    REPLICA={
+        'ALIASES': ['replica'],
+        'PIN_SECONDS': 5,
+        'VIEWS': (
+            'RecipeViewSet.list',
+            'RecipeViewSet.retrieve',
+            'download_shopping_cart',
+        ),
+    },
+)
+class ReplicaRoutingTest(TestCase):
+    """ Чтение с реплики; вторая база в тестах не реплицируется """
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        self.user = fixt.create_user(**fixt.FIRST_USER)
+        self.ingredient = fixt.create_ingredient()
+        self.recipe = fixt.create_recipe(
+            self.user, fixt.create_tag(), self.ingredient)
+        self.auth_client = APIClient()
+        self.auth_client.credentials(
+            HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user)}')
+
+    def get_count(self, api_client=client):
+        response = api_client.get('/api/recipes/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['count']
+
+    @tag('performance')
+    def test_reads_go_to_replica(self):
+        """Чтения выбранных обработчиков идут в реплику"""
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual(self.get_count(), 0)
+        self.assertTrue(queries.captured_queries)
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = client.get('/api/users/')
+            self.assertEqual(response.data['count'], 1)
+            self.assertEqual(self.get_count(self.auth_client), 0)
+        self.assertFalse(any(
+            'authtoken_token' in query['sql']
+            for query in queries.captured_queries
+        ))
+
+    @tag('performance')
+    def test_pinned_to_primary_after_write(self):
+        """После записи клиент читает с основной базы"""
+        response = self.auth_client.post(
+            f'/api/recipes/{self.recipe.pk}/favorite/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get_count(self.auth_client), 1)
+        self.assertEqual(self.get_count(), 0)
+        cache.clear()
+        self.assertEqual(self.get_count(self.auth_client), 0)
+
+    @tag('performance')
+    def test_streaming_response_reads_replica(self):
+        """Список покупок читается с реплики во время отдачи"""
+        CartIngredientsTotal.objects.create(
+            user=self.user, ingredients=self.ingredient, amount=3)
+        url = '/api/recipes/download_shopping_cart/'
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.auth_client.get(url)
+            self.assertEqual(b''.join(response.streaming_content), b'')
+        self.assertTrue(any(
+            'recipes_cartingredientstotal' in query['sql']
+            for query in queries.captured_queries
+        ))
+        self.auth_client.post(f'/api/recipes/{self.recipe.pk}/favorite/')
+        response = self.auth_client.get(url)
+        self.assertEqual(
+            b''.join(response.streaming_content),
+            'Test_ingredient (test_kg) - 3'.encode(),
+        )
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    })
+    def test_requires_shared_cache(self):
+        """Без общего кеша всё читается с основной базы"""
+        self.assertEqual(self.get_count(), 1)
+        self.assertIn(
+            'api.E002', [error.id for error in check_shared_cache(None)])
+
+    def test_router_without_request(self):
+        """Вне запросов всё идёт в основную базу"""
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Recipe), 'default')
+        self.assertEqual(router.db_for_write(Recipe), 'default')
@@ -0,0 +1,243 @@
+import io
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings, tag
+
+from api.management.commands._json import iter_array
+from api.models import DataSource
+from recipes.models import Cart, CartIngredientsTotal, Ingredients, Recipe, Tag
+from users.models import User
+
+USERS = (
+    'username,email,firs_name,last_name\n'
+    'first,first@test.ru,Полина,Любимова\n'
+    'second,second@test.ru,Виктория,Беляева\n'
+    'first,other@test.ru,Полина,Любимова\n'
+)
+TAGS = (
+    'Тэг,#FFFFFF,tag\n'
+    'Завтрак,#000000,breakfast\n'
+    'Обед,#0000FF,lunch\n'
+)
+INGREDIENTS = (
+    ('сахар', 'г'),
+    ('соль', 'г'),
+    ('вода', 'мл'),
+)
+
+
+def write_file(test, content, suffix):
+    file = tempfile.NamedTemporaryFile('w', suffix=suffix, encoding='utf8')
+    test.addCleanup(file.close)
+    file.write(content)
+    file.flush()
+    return file.name
+
+
+class ImportIngredientTest(TestCase):
+    """ Загрузка ингредиентов """
+    def import_ingredient(self, *args):
+        output = io.StringIO()
+        call_command(
+            'import_ingredient', *args, '--batch-size', '2', stdout=output)
+
+    @tag('commands')
+    def test_import_csv(self):
+        """Ингредиенты из csv загружаются без дублей"""
+        content = '\n'.join(','.join(row) for row in INGREDIENTS)
+        path = write_file(self, content, '.csv')
+        self.import_ingredient('--path', path)
+        self.import_ingredient('--path', path)
+        self.assertEqual(
+            set(Ingredients.objects.values_list('name', 'measurement_unit')),
+            set(INGREDIENTS),
+        )
+
+    @tag('commands')
+    def test_import_json(self):
+        """Ингредиенты из json загружаются без дублей"""
+        content = json.dumps([
+            {'name': name, 'measurement_unit': measurement_unit}
+            for name, measurement_unit in INGREDIENTS
+        ])
+        path = write_file(self, content, '.json')
+        self.import_ingredient('--json', '--path', path)
+        self.import_ingredient('--json', '--path', path)
+        self.assertEqual(Ingredients.objects.count(), len(INGREDIENTS))
+
+    @tag('commands')
+    def test_iter_array_small_chunks(self):
+        """json-массив разбирается по частям"""
+        items = [{'name': f'ингредиент {number}'} for number in range(50)]
+        file = io.StringIO(json.dumps(items, ensure_ascii=False))
+        self.assertEqual(list(iter_array(file, chunk_size=7)), items)
+
+
+class ImportUserTest(TestCase):
+    """ Загрузка пользователей """
+    @tag('commands')
+    def test_import_users_in_pool(self):
+        """Пароли хешируются в пуле процессов, дубли пропускаются"""
+        path = write_file(self, USERS, '.csv')
+        output = io.StringIO()
+        call_command(
+            'import_user', '--path', path, '--workers', '2', stdout=output)
+        self.assertIn(
+            'Добавлено: 2, обновлено: 0, без изменений: 1',
+            output.getvalue(),
+        )
+        user = User.objects.get(username='second')
+        self.assertEqual(user.first_name, 'Виктория')
+        self.assertTrue(user.has_usable_password())
+        self.assertTrue(User.objects.get(username='admin').is_superuser)
+
+
+class ImportAllTest(TestCase):
+    """ Загрузка всех данных """
+    def setUp(self):
+        base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(base_dir.cleanup)
+        self.data_dir = os.path.join(base_dir.name, 'data')
+        os.mkdir(self.data_dir)
+        self.write('ingredients.csv', 'сахар,г\nсоль,г\n')
+        self.write('users.csv', USERS)
+        self.write('tags.csv', TAGS)
+        settings = override_settings(BASE_DIR=base_dir.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def write(self, name, content):
+        with open(os.path.join(self.data_dir, name), 'w') as file:
+            file.write(content)
+
+    def import_all(self):
+        output = io.StringIO()
+        call_command('import_all', stdout=output)
+        return output.getvalue()
+
+    @tag('commands')
+    def test_unchanged_files_skipped(self):
+        """Не изменившиеся файлы пропускаются, изменённые догружаются"""
+        self.import_all()
+        self.assertEqual(DataSource.objects.count(), 3)
+        self.assertEqual(
+            sorted(Tag.objects.values_list('slug', flat=True)),
+            ['breakfast', 'lunch'],
+        )
+        output = self.import_all()
+        self.assertEqual(output.count('не изменился'), 3)
+
+        self.write('tags.csv', TAGS.replace('#000000', '#123456'))
+        output = self.import_all()
+        self.assertEqual(output.count('не изменился'), 2)
+        self.assertIn('обновлено: 1, без изменений: 1', output)
+        self.assertEqual(Tag.objects.get(slug='breakfast').color, '#123456')
+
+
+class GenerateDataTest(TestCase):
+    """ Генерация данных для нагрузочного тестирования """
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def generate(self, prefix):
+        call_command(
+            'generate_data',
+            '--users', '20',
+            '--recipes', '50',
+            '--ingredients', '30',
+            '--seed', '1',
+            '--prefix', prefix,
+            '--batch-size', '16',
+            stdout=io.StringIO(),
+        )
+        return list(
+            Recipe.objects.filter(name__startswith=prefix).order_by(
+                'name').values_list('author__username', 'cooking_time')
+        )
+
+    @tag('commands')
+    def test_generate_data(self):
+        """Данные генерируются воспроизводимо и согласованно"""
+        first = self.generate('first')
+        second = self.generate('second')
+        self.assertEqual(len(first), 50)
+        self.assertEqual(
+            first,
+            [
+                (username.replace('second', 'first'), cooking_time)
+                for username, cooking_time in second
+            ],
+        )
+        self.assertEqual(User.objects.count(), 40)
+        self.assertTrue(
+            all(recipe.tags.exists() for recipe in Recipe.objects.all()))
+        self.assertEqual(
+            CartIngredientsTotal.objects.exists(),
+            Cart.objects.filter(recipes__isnull=False).exists(),
+        )
+
+
+class BenchmarkTest(TestCase):
+    """ Замеры эндпоинтов на сгенерированных данных """
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        call_command(
+            'generate_data',
+            '--users', '10',
+            '--recipes', '30',
+            '--ingredients', '30',
+            stdout=io.StringIO(),
+        )
+        self.baselines = os.path.join(media_root.name, 'benchmarks.json')
+
+    def benchmark(self, *args):
+        output = io.StringIO()
+        call_command(
+            'benchmark',
+            '--iterations', '2',
+            '--warmup', '0',
+            '--baselines', self.baselines,
+            *args,
+            stdout=output,
+        )
+        return output.getvalue()
+
+    @tag('commands')
+    def test_benchmark(self):
+        """Результаты сохраняются и сравниваются с эталонными"""
+        recipes = Recipe.objects.count()
+        images_dir = os.path.join(settings.MEDIA_ROOT, 'recipe')
+        images = os.listdir(images_dir)
+        self.benchmark('--save')
+        self.assertEqual(Recipe.objects.count(), recipes)
+        self.assertEqual(os.listdir(images_dir), images)
+        with open(self.baselines, encoding='utf8') as file:
+            baselines = json.load(file)['sqlite']
+        self.assertIn('recipe_create', baselines)
+        self.assertIn('shopping_cart_download', baselines)
+
+        self.assertIn('Регрессий нет', self.benchmark('--tolerance', '1000'))
+        for result in baselines.values():
+            result['queries'] -= 1
+        with open(self.baselines, 'w', encoding='utf8') as file:
+            json.dump({'sqlite': baselines}, file)
+        with self.assertRaisesMessage(CommandError, 'recipes_list: запросов'):
+            self.benchmark('--tolerance', '1000')
+
+    @tag('commands')
+    def test_benchmark_iterations(self):
+        """Одного замера для перцентилей мало"""
+        with self.assertRaisesMessage(CommandError, '--iterations 2'):
+            self.benchmark('--iterations', '1')
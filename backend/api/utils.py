@@ -1,24 +1,61 @@
-def get_cart_items(recipes):
+from django.db.models import F, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+
+
+def get_subscribed_ids(request):
+    """
+    Возвращает множество id авторов, на которых подписан
+    пользователь запроса.
+    Загружается одним запросом и кешируется на время запроса,
+    чтобы is_subscribed для страницы авторов не стоил запрос на автора.
+    """
+    if not hasattr(request, '_subscribed_ids'):
+        user = request.user
+        request._subscribed_ids = set() if user.is_anonymous else set(
+            user.subscriber.values_list('author_id', flat=True)
+        )
+    return request._subscribed_ids
+
+
+def first_recipes_per_author(recipes, limit):
     """
-    Возвращает готовый к отправке список покупок.
-    Принимает список рецептов.
-    Возвращает список уникальных значений:
-    {Название ингредиента}, {формовка}: {суммарное количество}
+    Возвращает подзапрос с id первых `limit` рецептов каждого автора
+    из переданного queryset.
+    Нумерует рецепты через ROW_NUMBER() OVER (PARTITION BY author),
+    поэтому рецепты всех авторов страницы выбираются одним запросом.
     """
-    data = {}
-    for recipe in recipes:
-        for ingredient in recipe.ingredientsamount_set.all():
-            goods, amount, measurement_unit = (
-                ingredient.ingredients.name,
-                ingredient.amount,
-                ingredient.ingredients.measurement_unit,
-            )
-            name = (f'{goods} ({measurement_unit})')
-            if name in data:
-                data.update({name: amount + data.pop(name)})
-            else:
-                data.update({name: amount})
+    ranked = recipes.order_by().annotate(
+        recipe_number=Window(
+            expression=RowNumber(),
+            partition_by=F('author'),
+            order_by=(F('publication_date').desc(), F('id').desc()),
+        ),
+    ).values('id', 'recipe_number')
+    sql, params = ranked.query.sql_with_params()
+    return RawSQL(
+        f'SELECT id FROM ({sql}) ranked WHERE recipe_number <= %s',
+        (*params, limit),
+    )
+
 
-    return '\n'.join(
-        f'{key} - {str(value)}' for key, value in data.items()
+def get_cart_items(user):
+    """
+    Возвращает готовый к отправке список покупок построчно.
+    Принимает пользователя.
+    Читает заранее посчитанные суммы ингредиентов корзины
+    и отдаёт строки по мере чтения:
+    {Название ингредиента} ({формовка}) - {суммарное количество}
+    """
+    items = user.cart_totals.values_list(
+        'ingredients__name',
+        'ingredients__measurement_unit',
+        'amount',
+    ).order_by(
+        'ingredients__name',
+        'ingredients__measurement_unit',
     )
+    separator = ''
+    for name, measurement_unit, amount in items.iterator():
+        yield f'{separator}{name} ({measurement_unit}) - {amount}'
+        separator = '\n'
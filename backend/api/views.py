@@ -1,25 +1,38 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Count, Exists, OuterRef
-from django.http import HttpResponse
+from django.db.models import Count, Exists, OuterRef, Prefetch
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters import rest_framework as filter
 from djoser.serializers import SetPasswordSerializer
 from djoser.views import UserViewSet as DjoserUserViewSet
 from rest_framework import mixins, permissions, status, viewsets
 from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
+from .bitmaps import recipe_index
 from .filters import IngredientsFilter, RecipieFilter
-from .pagination import LimitPageNumberPagination
+from .metrics import (
+    WRITES, SerializerMetricsMixin, registry, timed_representation,
+)
+from .pagination import PageNumberOrCursorPagination
 from .permissions import IsAdminOrOwnerOrReadOnly, SubscriberOrAdmin
+from .registries import ingredients_index, tag_registry
 from .serializers import (
     CartSerializer, FavoriteSerializer, IngredientsSerializer,
-    RecipeCreateUpdateSerializer, RecipeSerializer,
+    RecipeCreateUpdateSerializer, RecipeIdsSerializer, RecipeSerializer,
     SubscribeCreateDeleteSerializer, SubscribeSerializer, TagSerializer,
     UserCreateSerializer, UserSerializer,
 )
-from .utils import get_cart_items
-from recipes.models import Cart, Favorite, Ingredients, Recipe, Tag
+from .utils import first_recipes_per_author, get_cart_items
+from recipes.models import (
+    Cart, Favorite, Ingredients, IngredientsAmount, Recipe, Tag,
+)
+from recipes.services import (
+    add_many_to_collection, add_to_collection, clear_cart,
+    remove_from_collection, remove_many_from_collection,
+)
 from users.models import Subscribe
 
 User = get_user_model()
@@ -32,16 +45,30 @@ def download_shopping_cart(request):
     Возвращает txt со списком покупок.
     """
     user = request.user
-    recipes = Cart.objects.get(user=user).recipes.all()
     filename = f'{user.username}-shopping-cart.txt'
-    cart_items = get_cart_items(recipes)
-    response = HttpResponse(cart_items, content_type='text/plain')
+    response = StreamingHttpResponse(
+        get_cart_items(user), content_type='text/plain')
     response['Content-Disposition'] = 'attachment; filename={0}'.format(
         filename)
     return response
 
 
+def metrics(request):
+    """
+    Метрики всех воркеров в текстовом формате Prometheus.
+    Доступны staff пользователям и адресам из METRICS_ALLOWED_IPS.
+    """
+    if (
+        request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS
+        and not request.user.is_staff
+    ):
+        raise Http404
+    return HttpResponse(
+        registry.render(), content_type='text/plain; version=0.0.4')
+
+
 class UserViewSet(
+    SerializerMetricsMixin,
     mixins.ListModelMixin,
     mixins.RetrieveModelMixin,
     mixins.CreateModelMixin,
@@ -50,7 +77,8 @@ class UserViewSet(
     serializer_class = UserSerializer
     queryset = User.objects.all()
     permission_classes = (permissions.IsAuthenticated,)
-    pagination_class = LimitPageNumberPagination
+    pagination_class = PageNumberOrCursorPagination
+    cursor_ordering = ('-date_joined', '-id')
 
     def get_user(self):
         return self.request.user
@@ -60,9 +88,45 @@ class UserViewSet(
             return self.queryset.filter(
                 subscribing__user=self.get_user()).annotate(
                 recipes_count=Count('recipe'),
+            ).prefetch_related(
+                Prefetch(
+                    'recipe',
+                    queryset=self.get_subscriptions_recipes(),
+                    to_attr='limited_recipes',
+                ),
             )
         return self.queryset
 
+    def get_recipes_limit(self):
+        recipes_limit = self.request.query_params.get('recipes_limit')
+        if not recipes_limit:
+            return None
+        if not recipes_limit.isdigit():
+            message = 'Параметр recipes_limit должен быть числом'
+            raise ValidationError(message)
+        recipes_limit = int(recipes_limit)
+        if recipes_limit < 0:
+            message = 'Параметр recipes_limit должен быть больше 0'
+            raise ValidationError(message)
+        return recipes_limit
+
+    def get_subscriptions_recipes(self):
+        """
+        Рецепты авторов из подписок. При переданном recipes_limit
+        первые N рецептов всех авторов страницы выбираются одним
+        запросом через ROW_NUMBER() по каждому автору.
+        """
+        recipes = Recipe.objects.all()
+        recipes_limit = self.get_recipes_limit()
+        if recipes_limit is None:
+            return recipes
+        return recipes.filter(
+            pk__in=first_recipes_per_author(
+                recipes.filter(author__subscribing__user=self.get_user()),
+                recipes_limit,
+            ),
+        )
+
     def get_permissions(self):
         if self.action in ('create', 'list', 'reset_password', ):
             self.permission_classes = (permissions.AllowAny,)
@@ -129,32 +193,50 @@ class UserViewSet(
         if request.method == 'DELETE':
             instance = Subscribe.objects.get(**serializer.initial_data)
             instance.delete()
+            WRITES.inc(model='subscribe', action='remove')
             return Response(status=status.HTTP_204_NO_CONTENT)
 
         serializer.save()
+        WRITES.inc(model='subscribe', action='add')
 
         queryset = self.get_queryset().get(id=pk)
         instance_serializer = SubscribeSerializer(queryset, context=context)
         return Response(instance_serializer.data, status.HTTP_201_CREATED)
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(SerializerMetricsMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer(tag_registry.all(), many=True)
+        return Response(serializer.data)
+
+    def retrieve(self, request, pk=None):
+        tag = tag_registry.get_by_pk(int(pk)) if pk.isdigit() else None
+        if tag is None:
+            raise Http404
+        return Response(self.get_serializer(tag).data)
+
 
-class IngredientsViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientsViewSet(
+    SerializerMetricsMixin, viewsets.ReadOnlyModelViewSet
+):
     queryset = Ingredients.objects.all()
     serializer_class = IngredientsSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     pagination_class = None
-    filter_backends = (IngredientsFilter,)
-    search_fields = ('^name',)
+
+    def list(self, request, *args, **kwargs):
+        terms = IngredientsFilter().get_search_terms(request)
+        serializer = self.get_serializer(
+            ingredients_index.search(terms), many=True)
+        return Response(serializer.data)
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(SerializerMetricsMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     permission_classes = (
@@ -163,19 +245,76 @@ class RecipeViewSet(viewsets.ModelViewSet):
     )
     filter_backends = (filter.DjangoFilterBackend,)
     filterset_class = RecipieFilter
-    pagination_class = LimitPageNumberPagination
+    pagination_class = PageNumberOrCursorPagination
+    cursor_ordering = ('-publication_date', '-id')
+
+    def filter_queryset(self, queryset):
+        """
+        Список без курсора фильтруется по битовому индексу, если
+        он включён; с невалидными параметрами ошибку вернёт
+        обычная фильтрация.
+        """
+        if (
+            self.action == 'list'
+            and recipe_index.is_enabled()
+            and not self.paginator.is_cursor_requested(self.request)
+        ):
+            filterset = self.filterset_class(
+                self.request.query_params, queryset, request=self.request)
+            if filterset.is_valid():
+                return filterset.filter_by_index(queryset)
+        return super().filter_queryset(queryset)
+
+    def list(self, request, *args, **kwargs):
+        """
+        С ?facets=tags в ответ добавляется число рецептов
+        каждого тэга при текущих фильтрах.
+        """
+        response = super().list(request, *args, **kwargs)
+        if 'tags' in request.query_params.get('facets', '').split(','):
+            response.data['facets'] = {'tags': self.get_tag_facets()}
+        return response
+
+    def get_tag_facets(self):
+        filterset = self.filterset_class(
+            self.request.query_params, self.get_queryset(),
+            request=self.request,
+        )
+        filterset.is_valid()
+        counts = filterset.get_tag_counts()
+        return [
+            {'id': tag.pk, 'slug': tag.slug, 'count': counts.get(tag.pk, 0)}
+            for tag in tag_registry.all()
+        ]
 
     def get_queryset(self):
         user = self.request.user
+        queryset = self.queryset
+        if self.action in ('list', 'retrieve'):
+            queryset = self.prefetch_for_representation(queryset)
         if user.is_anonymous:
-            return self.queryset
-        return self.queryset.annotate(
+            return queryset
+        return queryset.annotate(
             is_favorited=Exists(
                 user.favorite_set.filter(recipes=OuterRef('pk'))),
             is_in_shopping_cart=Exists(
                 user.cart_set.filter(recipes=OuterRef('pk'))),
         )
 
+    def prefetch_for_representation(self, queryset):
+        """
+        Подгружает всё, что нужно RecipeSerializer, фиксированным
+        числом запросов независимо от количества рецептов.
+        """
+        return queryset.select_related('author').prefetch_related(
+            'tags',
+            Prefetch(
+                'ingredientsamount_set',
+                queryset=IngredientsAmount.objects.select_related(
+                    'ingredients'),
+            ),
+        )
+
     def get_serializer_class(self):
         if self.action in ('create', 'update', 'partial_update'):
             return RecipeCreateUpdateSerializer
@@ -183,11 +322,15 @@ class RecipeViewSet(viewsets.ModelViewSet):
             return FavoriteSerializer
         elif self.action == 'shopping_cart':
             return CartSerializer
+        elif self.action in ('favorite_many', 'shopping_cart_many'):
+            return RecipeIdsSerializer
         return RecipeSerializer
 
     def create_update_repr(self, instanse, status):
-        instance_serializer = RecipeSerializer(
-            instanse, context={'request': self.request})
+        instanse = self.prefetch_for_representation(
+            self.queryset).get(pk=instanse.pk)
+        instance_serializer = timed_representation(RecipeSerializer(
+            instanse, context={'request': self.request}))
         return Response(instance_serializer.data, status)
 
     def create(self, request, *args, **kwargs):
@@ -214,14 +357,19 @@ class RecipeViewSet(viewsets.ModelViewSet):
             context={'request': request}
         )
         serializer.is_valid(raise_exception=True)
-
-        instance, _ = model.objects.get_or_create(user=self.request.user)
+        recipe = serializer.validated_data['recipes']
 
         if request.method == 'DELETE':
-            instance.recipes.remove(pk)
+            if not remove_from_collection(model, request.user, recipe.pk):
+                raise ValidationError(
+                    {'non_field_errors': ['Вы не добавляли этот рецепт']})
+            WRITES.inc(model=model._meta.model_name, action='remove')
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        instance.recipes.add(pk)
+        if not add_to_collection(model, request.user, recipe.pk):
+            raise ValidationError(
+                {'non_field_errors': ['Этот рецепт уже добавлен']})
+        WRITES.inc(model=model._meta.model_name, action='add')
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -232,3 +380,45 @@ class RecipeViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=('post', 'delete'))
     def shopping_cart(self, request, pk=None):
         return self.favorite_shopping_cart_mixin(request, Cart, pk)
+
+    def favorite_shopping_cart_many_mixin(self, request, model):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        recipe_ids = serializer.validated_data['recipes']
+
+        if request.method == 'DELETE':
+            results = remove_many_from_collection(
+                model, request.user, recipe_ids)
+            action = 'remove'
+        else:
+            results = add_many_to_collection(model, request.user, recipe_ids)
+            action = 'add'
+        changed = sum(
+            result in ('added', 'removed') for result in results.values())
+        if changed:
+            WRITES.inc(
+                changed, model=model._meta.model_name, action=action)
+
+        return Response({
+            'results': [
+                {'id': pk, 'result': result}
+                for pk, result in results.items()
+            ],
+        })
+
+    @action(detail=False, methods=('post', 'delete'), url_path='favorite')
+    def favorite_many(self, request):
+        return self.favorite_shopping_cart_many_mixin(request, Favorite)
+
+    @action(
+        detail=False, methods=('post', 'delete'), url_path='shopping_cart')
+    def shopping_cart_many(self, request):
+        return self.favorite_shopping_cart_many_mixin(request, Cart)
+
+    @action(
+        detail=False, methods=('delete',), url_path='shopping_cart/clear')
+    def clear_shopping_cart(self, request):
+        removed = clear_cart(request.user)
+        if removed:
+            WRITES.inc(removed, model='cart', action='remove')
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -50,10 +50,14 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.MetricsMiddleware',
+    'api.middleware.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.middleware.ProfilingMiddleware',
+    'api.middleware.ReplicaMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -95,11 +99,59 @@ DATABASES = {
         },
     }
 }
+# Реплики для чтения: DB_REPLICA_HOSTS через запятую
+REPLICA_ALIASES = []
+for number, host in enumerate(
+    filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(','))
+):
+    alias = f'replica_{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'TEST': {'MIRROR': 'default'},
+    }
+    REPLICA_ALIASES.append(alias)
 if 'test' in sys.argv:
-    DATABASES['default'] = {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': 'test_database'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'test_database'
+        },
+        # Отдельная база без репликации для тестов маршрутизации
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'test_replica'
+        },
     }
+    REPLICA_ALIASES = []
+
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+
+# Кеш хранит версии снимков в памяти воркеров, битового индекса рецептов
+# и привязку клиентов к основной базе, поэтому должен быть общим
+# для всех процессов (Redis). Без REDIS_URL кеш живёт в памяти процесса,
+# что подходит только для одного процесса: снимки тогда обновляются
+# не реже раза в SNAPSHOT_TTL секунд, а битовый индекс и чтение
+# с реплик не включаются. Версию снимка процесс перечитывает из кеша
+# не чаще раза в SNAPSHOT_CHECK_INTERVAL секунд
+
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL and 'test' not in sys.argv:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+SNAPSHOT_TTL = 60
+SNAPSHOT_CHECK_INTERVAL = 1
 
 
 # Password validation
@@ -171,3 +223,92 @@ DJOSER = {
 }
 
 ADMIN_EMPTY_VALUE_DISPLAY = '-пусто-'
+
+INGREDIENTS_AUTOCOMPLETE_LIMIT = 50
+
+
+# Бюджет SQL запросов на обработчик (ViewSet.action или имя маршрута)
+# и число повторов одного запроса, после которого он считается N+1
+
+QUERY_BUDGET = {
+    'DEFAULT': 30,
+    'REPEATED': 10,
+    'VIEWS': {
+        'RecipeViewSet.list': 10,
+        'RecipeViewSet.retrieve': 10,
+        'UserViewSet.list': 5,
+        'UserViewSet.subscriptions': 8,
+        'IngredientsViewSet.list': 2,
+        'TagViewSet.list': 2,
+    },
+}
+
+# Профилирование: доля запросов, которые профилируются всегда,
+# заголовок для профилирования по запросу staff пользователя,
+# интервал снятия стеков в секундах, каталог для профилей
+# и размер файла профиля, после которого он начинается заново
+
+PROFILING = {
+    'SAMPLE_RATE': float(os.getenv('PROFILING_SAMPLE_RATE', 0)),
+    'HEADER': 'X-Profile',
+    'INTERVAL': 0.005,
+    'DIR': os.getenv('PROFILING_DIR', os.path.join(BASE_DIR, 'profiles')),
+    'MAX_BYTES': 10 * 1024 * 1024,
+}
+
+# Фильтрация списка рецептов по битовому индексу в памяти процесса
+# (api.bitmaps) вместо SQL. Индекс строится при первом запросе
+# и требует общего кеша (REDIS_URL). Изменения доходят до других
+# процессов через журнал в кеше из RECIPE_BITMAP_CHANGES записей;
+# отставший сильнее процесс перестраивает индекс из базы
+
+RECIPE_BITMAP_INDEX = os.getenv('RECIPE_BITMAP_INDEX', '') == '1'
+RECIPE_BITMAP_CHANGES = 10000
+
+# Чтение с реплик для безопасных запросов к обработчикам VIEWS
+# (ViewSet.action или имя маршрута). После записи клиент PIN_SECONDS
+# секунд читает с основной базы и видит свои изменения.
+# Привязка хранится в кеше, поэтому реплики требуют общего кеша
+
+REPLICA = {
+    'ALIASES': REPLICA_ALIASES,
+    'PIN_SECONDS': int(os.getenv('DB_REPLICA_PIN_SECONDS', 5)),
+    'VIEWS': (
+        'RecipeViewSet.list',
+        'RecipeViewSet.retrieve',
+        'TagViewSet.list',
+        'TagViewSet.retrieve',
+        'IngredientsViewSet.list',
+        'IngredientsViewSet.retrieve',
+        'UserViewSet.list',
+        'UserViewSet.retrieve',
+        'UserViewSet.subscriptions',
+        'download_shopping_cart',
+    ),
+}
+
+# Метрики Prometheus на /metrics/ для staff и адресов из
+# METRICS_ALLOWED_IPS. При нескольких воркерах gunicorn нужен общий
+# каталог METRICS_DIR, куда воркеры раз в METRICS_FLUSH_INTERVAL
+# секунд сохраняют свои значения
+
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = 5
+METRICS_ALLOWED_IPS = os.getenv(
+    'METRICS_ALLOWED_IPS', '127.0.0.1').split(',')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api': {
+            'handlers': ['console'],
+            'level': os.getenv('API_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
@@ -16,7 +16,17 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from api.admin import profile_download, profiles
+from api.views import metrics
+
 urlpatterns = [
+    path('admin/profiles/', profiles, name='profiles'),
+    path(
+        'admin/profiles/<str:name>/',
+        profile_download,
+        name='profile_download'
+    ),
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
+    path('metrics/', metrics, name='metrics'),
 ]
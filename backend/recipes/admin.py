@@ -5,6 +5,7 @@ from django.utils.html import format_html
 from django.utils.http import urlencode
 
 from .models import Cart, Favorite, Ingredients, IngredientsAmount, Recipe, Tag
+from .services import change_recipe_totals, get_recipe_amounts
 
 
 @admin.register(Tag)
@@ -62,6 +63,12 @@ class RecipeAdmin(admin.ModelAdmin):
     save_on_top = True
     actions = ['Delete', ]
 
+    def save_related(self, request, form, formsets, change):
+        old_amounts = get_recipe_amounts(form.instance) if change else {}
+        super().save_related(request, form, formsets, change)
+        change_recipe_totals(
+            form.instance, old_amounts, get_recipe_amounts(form.instance))
+
     @admin.display(description='Текст')
     def get_text(self, obj):
         return obj.text[:50]
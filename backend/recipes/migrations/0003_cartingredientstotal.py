@@ -0,0 +1,54 @@
+# Generated by Django 4.0.6 on 2026-10-18 17:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_cart_totals(apps, schema_editor):
+    CartIngredientsTotal = apps.get_model('recipes', 'CartIngredientsTotal')
+    IngredientsAmount = apps.get_model('recipes', 'IngredientsAmount')
+    totals = IngredientsAmount.objects.filter(
+        recipe__cart__isnull=False,
+    ).values(
+        'recipe__cart__user_id', 'ingredients_id',
+    ).annotate(total=models.Sum('amount')).order_by()
+    CartIngredientsTotal.objects.bulk_create(
+        CartIngredientsTotal(
+            user_id=item['recipe__cart__user_id'],
+            ingredients_id=item['ingredients_id'],
+            amount=item['total'],
+        )
+        for item in totals.iterator()
+        if item['recipe__cart__user_id'] is not None
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartIngredientsTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField(verbose_name='Количество')),
+                ('ingredients', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recipes.ingredients', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cart_totals', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Ингредиент в корзине',
+                'verbose_name_plural': 'Ингредиенты в корзинах',
+                'ordering': ('-user',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='cartingredientstotal',
+            constraint=models.UniqueConstraint(fields=('user', 'ingredients'), name='unique_cart_ingredient_total'),
+        ),
+        migrations.RunPython(fill_cart_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.0.6 on 2026-10-18 17:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_cartingredientstotal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['user', 'id'], name='cart_user_covering_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='favorite',
+            index=models.Index(fields=['user', 'id'], name='favorite_user_covering_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-publication_date', '-id'], name='recipe_publication_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', '-publication_date', '-id'], name='recipe_author_publication_idx'),
+        ),
+        # Таблицы связей ManyToManyField создаются автоматически,
+        # поэтому индексы для них добавляются SQL.
+        migrations.RunSQL(
+            'CREATE INDEX recipe_tags_tag_recipe_idx '
+            'ON recipes_recipe_tags (tag_id, recipe_id);',
+            'DROP INDEX recipe_tags_tag_recipe_idx;',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX favorite_recipes_recipe_idx '
+            'ON recipes_favorite_recipes (recipe_id, favorite_id);',
+            'DROP INDEX favorite_recipes_recipe_idx;',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX cart_recipes_recipe_idx '
+            'ON recipes_cart_recipes (recipe_id, cart_id);',
+            'DROP INDEX cart_recipes_recipe_idx;',
+        ),
+    ]
@@ -124,6 +124,16 @@ class Recipe(models.Model):
         ordering = ('-publication_date',)
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = (
+            models.Index(
+                fields=('-publication_date', '-id'),
+                name='recipe_publication_idx',
+            ),
+            models.Index(
+                fields=('author', '-publication_date', '-id'),
+                name='recipe_author_publication_idx',
+            ),
+        )
 
     def __str__(self):
         return self.name
@@ -179,6 +189,12 @@ class Favorite(FavoriteAndCartBaseContent):
 
     class Meta:
         ordering = ('-user',)
+        indexes = (
+            models.Index(
+                fields=('user', 'id'),
+                name='favorite_user_covering_idx',
+            ),
+        )
         verbose_name = 'Избраный рецепт'
         verbose_name_plural = 'Избраные рецепты'
 
@@ -187,5 +203,47 @@ class Cart(FavoriteAndCartBaseContent):
 
     class Meta:
         ordering = ('-user',)
+        indexes = (
+            models.Index(
+                fields=('user', 'id'),
+                name='cart_user_covering_idx',
+            ),
+        )
         verbose_name = 'Корзина покупок'
         verbose_name_plural = 'Корзины покупок'
+
+
+class CartIngredientsTotal(models.Model):
+    """
+    Суммарное количество ингредиента во всех рецептах корзины
+    пользователя. Поддерживается инкрементально при изменении
+    корзины и ингредиентов рецептов, см. recipes.services.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cart_totals',
+        verbose_name='Пользователь',
+    )
+    ingredients = models.ForeignKey(
+        Ingredients,
+        on_delete=models.CASCADE,
+        verbose_name='Ингредиент',
+    )
+    amount = models.PositiveIntegerField(
+        verbose_name='Количество',
+    )
+
+    class Meta:
+        ordering = ('-user',)
+        verbose_name = 'Ингредиент в корзине'
+        verbose_name_plural = 'Ингредиенты в корзинах'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'ingredients'),
+                name='unique_cart_ingredient_total'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.user} - {self.ingredients}'
@@ -0,0 +1,279 @@
+from collections import Counter, defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.dispatch import Signal
+
+from .models import Cart, CartIngredientsTotal, IngredientsAmount, Recipe
+
+# Изменение избранного или корзины записью напрямую в таблицу связей,
+# минуя m2m_changed. Аргументы: model, user_id, recipe_ids
+# (None - убраны все рецепты), added.
+collection_changed = Signal()
+
+
+def apply_cart_deltas(deltas):
+    """
+    Применяет изменения к суммам ингредиентов в корзинах.
+    Принимает {(user_id, ingredient_id): изменение количества}.
+    Строки с нулевой суммой удаляются.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    with transaction.atomic():
+        # select_for_update по суммам не блокирует ещё не созданные
+        # строки, поэтому изменения сумм пользователя выполняются по
+        # очереди под блокировкой его корзин. Порядок по pk исключает
+        # взаимную блокировку транзакций с несколькими пользователями.
+        list(Cart.objects.select_for_update().filter(
+            user_id__in={user_id for user_id, _ in deltas},
+        ).order_by('pk').values_list('pk', flat=True))
+        totals = {
+            (total.user_id, total.ingredients_id): total
+            for total in CartIngredientsTotal.objects.select_for_update(
+            ).filter(
+                user_id__in={user_id for user_id, _ in deltas},
+                ingredients_id__in={ingr_id for _, ingr_id in deltas},
+            )
+        }
+        to_create, to_update, to_delete = [], [], []
+        for (user_id, ingredient_id), delta in deltas.items():
+            total = totals.get((user_id, ingredient_id))
+            if total is None:
+                if delta > 0:
+                    to_create.append(CartIngredientsTotal(
+                        user_id=user_id,
+                        ingredients_id=ingredient_id,
+                        amount=delta,
+                    ))
+                continue
+            total.amount += delta
+            if total.amount > 0:
+                to_update.append(total)
+            else:
+                to_delete.append(total.pk)
+        CartIngredientsTotal.objects.bulk_create(to_create)
+        CartIngredientsTotal.objects.bulk_update(to_update, ('amount',))
+        CartIngredientsTotal.objects.filter(pk__in=to_delete).delete()
+
+
+def change_cart_totals(memberships, sign=1):
+    """
+    Добавляет (sign=1) или вычитает (sign=-1) ингредиенты рецептов
+    из сумм корзин. Принимает пары (user_id, recipe_id).
+    """
+    users_by_recipe = defaultdict(list)
+    for user_id, recipe_id in memberships:
+        users_by_recipe[recipe_id].append(user_id)
+    if not users_by_recipe:
+        return
+    deltas = Counter()
+    amounts = IngredientsAmount.objects.filter(
+        recipe_id__in=users_by_recipe,
+    ).values_list('recipe_id', 'ingredients_id', 'amount')
+    for recipe_id, ingredient_id, amount in amounts:
+        for user_id in users_by_recipe[recipe_id]:
+            deltas[user_id, ingredient_id] += sign * amount
+    apply_cart_deltas(deltas)
+
+
+def change_recipe_totals(recipe, old_amounts, new_amounts):
+    """
+    Переносит изменение ингредиентов рецепта в суммы всех корзин,
+    где он лежит. Принимает {ingredient_id: amount} до и после.
+    """
+    amounts_delta = Counter(new_amounts)
+    amounts_delta.subtract(old_amounts)
+    if not any(amounts_delta.values()):
+        return
+    deltas = Counter()
+    for user_id in Cart.objects.filter(recipes=recipe).values_list(
+        'user_id', flat=True
+    ):
+        for ingredient_id, delta in amounts_delta.items():
+            deltas[user_id, ingredient_id] += delta
+    apply_cart_deltas(deltas)
+
+
+def get_collection_id(model, user):
+    """Возвращает id избранного или корзины пользователя, создавая их."""
+    collection_id = model.objects.filter(user=user).order_by(
+        'pk').values_list('pk', flat=True).first()
+    if collection_id is None:
+        collection_id = model.objects.create(user=user).pk
+    return collection_id
+
+
+def add_to_collection(model, user, recipe_id):
+    """
+    Добавляет рецепт в избранное или корзину (model) пользователя
+    одной вставкой в таблицу связей. Возвращает False, если рецепт
+    уже был добавлен.
+    Вставка минует m2m_changed, поэтому суммы корзины
+    пересчитываются здесь.
+    """
+    Through = model.recipes.through
+    owner_field = f'{model._meta.model_name}_id'
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                Through.objects.create(**{
+                    owner_field: get_collection_id(model, user),
+                    'recipe_id': recipe_id,
+                })
+        except IntegrityError:
+            return False
+        if model is Cart:
+            change_cart_totals([(user.pk, recipe_id)])
+    collection_changed.send(
+        sender=model, model=model, user_id=user.pk,
+        recipe_ids=[recipe_id], added=True,
+    )
+    return True
+
+
+def remove_from_collection(model, user, recipe_id):
+    """
+    Убирает рецепт из избранного или корзины пользователя одним
+    удалением из таблицы связей. Возвращает False, если рецепта там не было.
+    """
+    links = get_collection_links(model, user).filter(recipe_id=recipe_id)
+    with transaction.atomic():
+        deleted, _ = links.delete()
+        if deleted and model is Cart:
+            change_cart_totals([(user.pk, recipe_id)] * deleted, -1)
+    if deleted:
+        collection_changed.send(
+            sender=model, model=model, user_id=user.pk,
+            recipe_ids=[recipe_id], added=False,
+        )
+    return bool(deleted)
+
+
+def get_collection_links(model, user):
+    return model.recipes.through.objects.filter(**{
+        f'{model._meta.model_name}__user': user,
+    })
+
+
+def add_many_to_collection(model, user, recipe_ids):
+    """
+    Добавляет рецепты в избранное или корзину пользователя
+    одной транзакцией. Возвращает {recipe_id: результат}, где
+    результат - 'added', 'already_added' или 'not_found'.
+    """
+    found = set(
+        Recipe.objects.filter(pk__in=recipe_ids).values_list('pk', flat=True))
+    Through = model.recipes.through
+    owner_field = f'{model._meta.model_name}_id'
+    with transaction.atomic():
+        collection_id = get_collection_id(model, user)
+        # Блокируем строку избранного или корзины, чтобы параллельные
+        # запросы пользователя не посчитали суммы корзины дважды.
+        list(model.objects.select_for_update().filter(pk=collection_id))
+        existing = set(
+            Through.objects.filter(**{
+                owner_field: collection_id,
+                'recipe_id__in': found,
+            }).values_list('recipe_id', flat=True)
+        )
+        added = [pk for pk in recipe_ids if pk in found - existing]
+        Through.objects.bulk_create(
+            (
+                Through(**{owner_field: collection_id, 'recipe_id': pk})
+                for pk in added
+            ),
+            ignore_conflicts=True,
+        )
+        if model is Cart:
+            change_cart_totals((user.pk, pk) for pk in added)
+    if added:
+        collection_changed.send(
+            sender=model, model=model, user_id=user.pk,
+            recipe_ids=added, added=True,
+        )
+    return {
+        pk: (
+            'not_found' if pk not in found
+            else 'already_added' if pk in existing
+            else 'added'
+        )
+        for pk in recipe_ids
+    }
+
+
+def remove_many_from_collection(model, user, recipe_ids):
+    """
+    Убирает рецепты из избранного или корзины пользователя
+    одной транзакцией. Возвращает {recipe_id: результат}, где
+    результат - 'removed' или 'not_added'.
+    """
+    links = get_collection_links(model, user).filter(
+        recipe_id__in=recipe_ids)
+    with transaction.atomic():
+        removed = list(
+            links.select_for_update().values_list('recipe_id', flat=True))
+        links.delete()
+        if model is Cart:
+            change_cart_totals(((user.pk, pk) for pk in removed), -1)
+    if removed:
+        collection_changed.send(
+            sender=model, model=model, user_id=user.pk,
+            recipe_ids=removed, added=False,
+        )
+    removed = set(removed)
+    return {
+        pk: 'removed' if pk in removed else 'not_added'
+        for pk in recipe_ids
+    }
+
+
+def clear_cart(user):
+    """Очищает корзину пользователя вместе с суммами ингредиентов."""
+    with transaction.atomic():
+        deleted, _ = get_collection_links(Cart, user).delete()
+        CartIngredientsTotal.objects.filter(user=user).delete()
+    if deleted:
+        collection_changed.send(
+            sender=Cart, model=Cart, user_id=user.pk,
+            recipe_ids=None, added=False,
+        )
+    return deleted
+
+
+def get_recipe_amounts(recipe):
+    """Возвращает {ingredient_id: amount} для рецепта."""
+    return dict(
+        recipe.ingredientsamount_set.values_list('ingredients_id', 'amount')
+    )
+
+
+def rebuild_cart_totals(users=None):
+    """
+    Пересчитывает суммы ингредиентов корзин с нуля одним
+    сгруппированным запросом. Нужен после массовых вставок
+    в корзины, минующих сигналы.
+    """
+    totals = CartIngredientsTotal.objects.all()
+    amounts = IngredientsAmount.objects.filter(recipe__cart__isnull=False)
+    if users is not None:
+        totals = totals.filter(user__in=users)
+        amounts = amounts.filter(recipe__cart__user__in=users)
+    amounts = amounts.values(
+        'recipe__cart__user_id', 'ingredients_id',
+    ).annotate(total=Sum('amount')).order_by()
+    with transaction.atomic():
+        totals.delete()
+        CartIngredientsTotal.objects.bulk_create(
+            (
+                CartIngredientsTotal(
+                    user_id=item['recipe__cart__user_id'],
+                    ingredients_id=item['ingredients_id'],
+                    amount=item['total'],
+                )
+                for item in amounts.iterator()
+                if item['recipe__cart__user_id'] is not None
+            ),
+            batch_size=1000,
+        )
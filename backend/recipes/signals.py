@@ -0,0 +1,40 @@
+from django.db.models.signals import m2m_changed, pre_delete
+from django.dispatch import receiver
+
+from .models import Cart, Recipe
+from .services import change_cart_totals
+
+CartRecipes = Cart.recipes.through
+
+
+def get_memberships(links):
+    return links.values_list('cart__user_id', 'recipe_id')
+
+
+@receiver(m2m_changed, sender=CartRecipes)
+def update_totals_on_cart_change(instance, action, reverse, pk_set, **kwargs):
+    """Пересчитывает суммы ингредиентов при изменении корзины."""
+    if action not in ('post_add', 'pre_remove', 'pre_clear'):
+        return
+    if reverse:
+        links = CartRecipes.objects.filter(recipe=instance)
+        if pk_set is not None:
+            links = links.filter(cart_id__in=pk_set)
+    else:
+        links = CartRecipes.objects.filter(cart=instance)
+        if pk_set is not None:
+            links = links.filter(recipe_id__in=pk_set)
+    sign = 1 if action == 'post_add' else -1
+    change_cart_totals(get_memberships(links), sign)
+
+
+@receiver(pre_delete, sender=Cart)
+def update_totals_on_cart_delete(instance, **kwargs):
+    change_cart_totals(
+        get_memberships(CartRecipes.objects.filter(cart=instance)), -1)
+
+
+@receiver(pre_delete, sender=Recipe)
+def update_totals_on_recipe_delete(instance, **kwargs):
+    change_cart_totals(
+        get_memberships(CartRecipes.objects.filter(recipe=instance)), -1)
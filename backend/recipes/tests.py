@@ -6,7 +6,11 @@ from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings, tag
 
-from .models import Cart, Favorite, Ingredients, IngredientsAmount, Recipe, Tag
+from .models import (
+    Cart, CartIngredientsTotal, Favorite, Ingredients, IngredientsAmount,
+    Recipe, Tag,
+)
+from .services import change_recipe_totals, get_recipe_amounts
 
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
@@ -253,3 +257,67 @@ class RecipesModelsTest(TestCase):
                 META_ORDERING[class_name],
                 msg=msg,
             )
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class CartIngredientsTotalTest(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        tag = create_tag()
+        self.sugar = create_ingredient('сахар', 'г')
+        self.salt = create_ingredient('соль', 'г')
+        self.sugar.save()
+        self.salt.save()
+        self.first = create_recipe(self.user, 'first', tag, self.sugar)
+        self.second = create_recipe(self.user, 'second', tag, self.sugar)
+        IngredientsAmount.objects.bulk_create((
+            IngredientsAmount(
+                recipe=self.first, ingredients=self.sugar, amount=10),
+            IngredientsAmount(
+                recipe=self.first, ingredients=self.salt, amount=1),
+            IngredientsAmount(
+                recipe=self.second, ingredients=self.sugar, amount=5),
+        ))
+        self.cart = Cart.objects.create(user=self.user)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def get_totals(self):
+        return dict(
+            CartIngredientsTotal.objects.filter(user=self.user).values_list(
+                'ingredients__name', 'amount')
+        )
+
+    @tag('models')
+    def test_totals_follow_cart_changes(self):
+        """Суммы ингредиентов обновляются вместе с корзиной."""
+        self.cart.recipes.add(self.first, self.second)
+        self.assertEqual(self.get_totals(), {'сахар': 15, 'соль': 1})
+
+        self.cart.recipes.remove(self.first)
+        self.assertEqual(self.get_totals(), {'сахар': 5})
+
+        self.second.cart_set.add(Cart.objects.create(user=self.user))
+        self.assertEqual(self.get_totals(), {'сахар': 10})
+
+        self.cart.recipes.clear()
+        self.assertEqual(self.get_totals(), {'сахар': 5})
+
+        self.second.delete()
+        self.assertEqual(self.get_totals(), {})
+
+    @tag('models')
+    def test_totals_follow_recipe_ingredients(self):
+        """Суммы ингредиентов обновляются при изменении рецепта."""
+        self.cart.recipes.add(self.first)
+        old_amounts = get_recipe_amounts(self.first)
+        self.first.ingredientsamount_set.filter(
+            ingredients=self.salt).delete()
+        self.first.ingredientsamount_set.filter(
+            ingredients=self.sugar).update(amount=3)
+        change_recipe_totals(
+            self.first, old_amounts, get_recipe_amounts(self.first))
+        self.assertEqual(self.get_totals(), {'сахар': 3})
@@ -77,6 +77,12 @@ class Subscribe(models.Model):
         ordering = ('-user',)
         verbose_name = 'Подписка'
         verbose_name_plural = 'Подписки'
+        indexes = (
+            models.Index(
+                fields=('author', 'user'),
+                name='subscribe_author_user_idx',
+            ),
+        )
         constraints = (
             UniqueConstraint(
                 fields=('user', 'author'),